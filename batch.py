@@ -0,0 +1,220 @@
+import hashlib
+import os
+import struct
+import zlib
+from protocol import (
+    CHUNK_SIZE, DATA, END, INCOMPRESSIBLE, MIN_COMPRESS_SIZE, MIN_RATIO, SAMPLE_SIZE,
+    Compressor, ProtocolError, count_compression, make_decompressor, recv_frame, send_frame,
+)
+
+# many small files travel as one archive stream instead of one request each.
+# every record is RECORD (flag, path length, size, mtime) + utf-8 path + the
+# file's bytes; the whole stream may go through the session's compressor and
+# is cut into DATA frames ending with END.
+RECORD = struct.Struct("!BHQd")
+PRESENT = 0
+MISSING = 1
+# a file that grew past the batch cap since it was listed; no data follows and
+# the sender transfers it on its own instead
+TOO_LARGE = 2
+TOO_LARGE_ERROR = "too large for a batch"
+
+# files up to this size are batched, up to BATCH_FILES / BATCH_BYTES per batch
+BATCH_MAX_FILE = 64 * 1024
+BATCH_FILES = 1000
+BATCH_BYTES = 8 * 1024 * 1024
+
+
+def encode_path(path):
+    return path.encode("utf-8", "surrogateescape")
+
+
+class BatchPacker:
+    def __init__(self, sock, rid, codec=None):
+        self.sock = sock
+        self.rid = rid
+        self.comp = Compressor(codec) if codec else None
+        self.out = bytearray()
+        self.raw = 0
+        self.wire = 0
+
+    def add(self, path, data, mtime, flag=PRESENT):
+        name = encode_path(path)
+        self._write(RECORD.pack(flag, len(name), len(data), mtime) + name)
+        if data:
+            self._write(data)
+
+    def _write(self, data):
+        self.raw += len(data)
+        if self.comp is not None:
+            data = self.comp.compress(data)
+        self.out += data
+        while len(self.out) >= CHUNK_SIZE:
+            self._send(CHUNK_SIZE)
+
+    def _send(self, n):
+        send_frame(self.sock, DATA, self.rid, bytes(self.out[:n]))
+        self.wire += n
+        del self.out[:n]
+
+    def finish(self):
+        if self.comp is not None:
+            self.out += self.comp.finish()
+            count_compression(self.raw, self.wire + len(self.out))
+        while self.out:
+            self._send(min(CHUNK_SIZE, len(self.out)))
+        send_frame(self.sock, END, self.rid)
+
+
+class BatchUnpacker:
+    # writes every record to <path>.part and renames it into place as soon as
+    # the record is complete; results maps path -> None or an error string.
+    # with a hash index, each file's digest is stored from the record itself;
+    # landed(path) is called as each file is renamed into place. records over
+    # max_file bytes are not buffered: their data is skipped and the path is
+    # reported as too large, so the sender streams it on its own
+    def __init__(self, local_dir, index=None, landed=None, max_file=BATCH_MAX_FILE):
+        self.local_dir = local_dir
+        self.index = index
+        self.landed = landed
+        self.max_file = max_file
+        self.pending = bytearray()
+        self.skip = 0
+        self.results = {}
+
+    def feed(self, data):
+        self.pending += data
+        while True:
+            if self.skip:
+                n = min(self.skip, len(self.pending))
+                del self.pending[:n]
+                self.skip -= n
+                if self.skip:
+                    break
+            if len(self.pending) < RECORD.size:
+                break
+            flag, name_len, size, mtime = RECORD.unpack_from(self.pending)
+            name_end = RECORD.size + name_len
+            oversized = size > self.max_file
+            end = name_end if oversized else name_end + size
+            if len(self.pending) < end:
+                break
+            path = bytes(self.pending[RECORD.size:name_end]).decode("utf-8", "surrogateescape")
+            if oversized:
+                print(f"WARNING: batch record for {path} is {size} bytes, over the {self.max_file} byte cap")
+                self.results[path] = TOO_LARGE_ERROR
+                self.skip = size
+            elif flag == MISSING:
+                self.results[path] = "not found"
+            elif flag == TOO_LARGE:
+                self.results[path] = TOO_LARGE_ERROR
+            else:
+                self._store(path, self.pending[name_end:end], mtime)
+            del self.pending[:end]
+
+    def _store(self, path, data, mtime):
+        abs_path = os.path.join(self.local_dir, path)
+        temp_path = abs_path + ".part"
+        try:
+            os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, abs_path)
+            os.utime(abs_path, (mtime, mtime))
+            if self.index is not None:
+                self.index.store(path, os.stat(abs_path), hashlib.sha256(data).hexdigest())
+            self.results[path] = None
+            if self.landed is not None:
+                self.landed(path)
+        except OSError as e:
+            self.results[path] = str(e)
+
+    def read_stream(self, rfile, rid, codec=None, buf=None):
+        decomp = make_decompressor(codec)
+        while True:
+            frame = recv_frame(rfile, buf)
+            if frame is None:
+                raise ConnectionError("connection closed in the middle of a batch")
+            ftype, frame_rid, payload = frame
+            if frame_rid != rid:
+                raise ProtocolError(f"frame for request {frame_rid} while receiving {rid}")
+            if ftype == END:
+                break
+            if ftype != DATA:
+                raise ProtocolError(f"expected batch data, got frame type {ftype}")
+            self.feed(decomp.decompress(payload) if decomp is not None else payload)
+        if self.pending or self.skip:
+            raise ProtocolError(f"batch ended inside a record ({len(self.pending)} bytes left)")
+        return self.results
+
+
+def batch_codec(local_dir, paths, codec):
+    # the codec a batch goes out with, decided before its header is sent by
+    # choose_codec's rules applied to the batch as a whole: none if most of
+    # its files have an already compressed extension, or if the first
+    # SAMPLE_SIZE bytes of the others don't shrink
+    if codec is None:
+        return None
+    others = [p for p in paths if os.path.splitext(p)[1].lower() not in INCOMPRESSIBLE]
+    if len(others) * 2 < len(paths):
+        count_compression(0, 0, skipped=True)
+        return None
+    sample = bytearray()
+    for path in others:
+        if len(sample) >= SAMPLE_SIZE:
+            break
+        try:
+            with open(os.path.join(local_dir, path), "rb") as f:
+                sample += f.read(SAMPLE_SIZE - len(sample))
+        except OSError:
+            continue
+    if len(sample) < MIN_COMPRESS_SIZE:
+        return None
+    if len(zlib.compress(bytes(sample), 1)) > len(sample) * MIN_RATIO:
+        count_compression(0, 0, skipped=True)
+        return None
+    return codec
+
+
+def pack_files(packer, local_dir, paths, max_file=BATCH_MAX_FILE):
+    # returns the paths that couldn't be read; they go out as MISSING records.
+    # a file that is now over max_file goes out as a TOO_LARGE record instead
+    # of being read into memory, and is reported with TOO_LARGE_ERROR
+    unreadable = {}
+    for path in paths:
+        try:
+            with open(os.path.join(local_dir, path), "rb") as f:
+                st = os.fstat(f.fileno())
+                # read one byte past the cap: the file may grow after the fstat
+                data = f.read(max_file + 1) if st.st_size <= max_file else None
+        except OSError as e:
+            unreadable[path] = "not found" if isinstance(e, FileNotFoundError) else str(e)
+            packer.add(path, b"", 0, MISSING)
+            continue
+        if data is None or len(data) > max_file:
+            unreadable[path] = TOO_LARGE_ERROR
+            packer.add(path, b"", 0, TOO_LARGE)
+            continue
+        packer.add(path, data, st.st_mtime)
+    packer.finish()
+    return unreadable
+
+
+def group_small(entries, max_file=BATCH_MAX_FILE, max_files=BATCH_FILES, max_bytes=BATCH_BYTES):
+    # splits entries into (batches of small paths, everything else)
+    batches, rest = [], []
+    cur, cur_bytes = [], 0
+    for e in entries:
+        if not isinstance(e, dict) or e.get("size", max_file + 1) > max_file:
+            rest.append(e)
+            continue
+        if cur and (len(cur) >= max_files or cur_bytes + e["size"] > max_bytes):
+            batches.append(cur)
+            cur, cur_bytes = [], 0
+        cur.append(e["path"])
+        cur_bytes += e["size"]
+    if cur:
+        batches.append(cur)
+    # a batch of one is just a slower single transfer
+    rest.extend(b[0] for b in batches if len(b) == 1)
+    return [b for b in batches if len(b) > 1], rest
@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import metrics
+from sync_core import scan_dir, SCAN_WORKERS
+from hash_index import HashIndex
+from hasher import hash_many
+from tls_client import make_client_context, open_session, plan_actions
+from transfer import sync, STRIPES
+
+# end-to-end benchmark: throwaway certificates, a synthetic tree and a real
+# server process on loopback. every phase is timed and the results are
+# printed as one JSON document so runs can be compared over time.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_certs(cert_dir):
+    names = {}
+    for name in ("server", "client"):
+        crt, key = os.path.join(cert_dir, f"{name}.crt"), os.path.join(cert_dir, f"{name}.key")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", f"/CN=filesync-bench-{name}", "-keyout", key, "-out", crt],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        names[name] = (crt, key)
+    return names
+
+
+def write_file(path, size, random_data):
+    with open(path, "wb") as f:
+        if random_data:
+            left = size
+            while left:
+                n = min(left, 1 << 20)
+                f.write(os.urandom(n))
+                left -= n
+        else:
+            line = f"{os.path.basename(path)} filesync benchmark line\n".encode()
+            f.write((line * (size // len(line) + 1))[:size])
+
+
+def make_tree(root, small, small_size, huge, huge_mb, depth):
+    # many small text files in a two-level fan-out, a few huge random files
+    # and one deeply nested chain of directories with a file at every level
+    for i in range(small):
+        d = os.path.join(root, "small", f"d{i // 1000:03d}", f"e{i // 100 % 10}")
+        if i % 100 == 0:
+            os.makedirs(d, exist_ok=True)
+        write_file(os.path.join(d, f"f{i}.txt"), small_size // 2 + i % small_size, False)
+    if huge:
+        os.makedirs(os.path.join(root, "huge"), exist_ok=True)
+    for i in range(huge):
+        write_file(os.path.join(root, "huge", f"h{i}.bin"), huge_mb << 20, True)
+    d = os.path.join(root, "deep")
+    for i in range(depth):
+        d = os.path.join(d, f"level{i}")
+        os.makedirs(d, exist_ok=True)
+        write_file(os.path.join(d, "leaf.txt"), small_size, False)
+
+
+def tree_size(root):
+    files = scan_dir(root, workers=1)
+    return len(files), sum(e["size"] for e in files)
+
+
+def tree_digests(root):
+    # path -> sha-256 of every file, read from disk rather than an index so a
+    # file that arrived with the right size but wrong bytes is caught
+    files = scan_dir(root, workers=1)
+    return dict(hash_many((e["path"], os.path.join(root, e["path"])) for e in files))
+
+
+def start_server(work, certs, data_dir, max_connections):
+    srv_dir = os.path.join(work, "server")
+    os.makedirs(srv_dir)
+    with open(os.path.join(srv_dir, "sync_config.json"), "w") as f:
+        json.dump({"local_dir": data_dir, "hash_index": True, "live_index": True, "server": {"metrics_port": 0}}, f)
+    log_path = os.path.join(work, "server.log")
+    code = (
+        "import sys; sys.path.insert(0, sys.argv[1]);"
+        "from tls_server import serve, make_server_context;"
+        "serve('127.0.0.1', 0, make_server_context(*sys.argv[2:5]), int(sys.argv[5]))"
+    )
+    log = open(log_path, "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-u", "-c", code, HERE, *certs["server"], certs["client"][0], str(max_connections)],
+        cwd=srv_dir, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        with open(log_path) as f:
+            for line in f:
+                if line.startswith("Server listening on "):
+                    port = int(line.split()[3].rsplit(":", 1)[1])
+                    return proc, port
+        if proc.poll() is not None:
+            break
+        time.sleep(0.05)
+    proc.kill()
+    with open(log_path) as f:
+        raise SystemExit(f"benchmark server did not start:\n{f.read()}")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def peak_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(rss / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+class Bench:
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.phases = {}
+
+    def run(self, name, fn, files=0, size=0):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if self.verbose else out):
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+        self.phases[name] = {
+            "seconds": round(elapsed, 4),
+            "files": files,
+            "bytes": size,
+            "files_per_sec": round(files / elapsed, 1) if elapsed else None,
+            "mb_per_sec": round(size / elapsed / (1 << 20), 2) if elapsed and size else None,
+        }
+        print(f"{name:<12} {elapsed:8.2f}s {files:>9} files {self.phases[name]['mb_per_sec'] or 0:10.2f} MB/s", file=sys.stderr)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end sync benchmark against a loopback server")
+    parser.add_argument("--small", type=int, default=20000, help="number of small files")
+    parser.add_argument("--small-size", type=int, default=4096, help="approximate small file size in bytes")
+    parser.add_argument("--huge", type=int, default=2, help="number of huge files")
+    parser.add_argument("--huge-mb", type=int, default=256, help="size of each huge file in MiB")
+    parser.add_argument("--depth", type=int, default=64, help="depth of the nested directory chain")
+    parser.add_argument("--workers", type=int, default=SCAN_WORKERS, help="scan threads")
+    parser.add_argument("--concurrency", type=int, default=1, help="transfer sessions (max_concurrency)")
+    parser.add_argument("--stripes", type=int, default=STRIPES, help="parallel connections per large file, 1 disables striping")
+    parser.add_argument("--max-connections", type=int, default=16)
+    parser.add_argument("--out", help="also write the JSON report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--verbose", action="store_true", help="show client output for every phase")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="filesync-bench-")
+    proc = None
+    try:
+        certs = make_certs(work)
+        src = os.path.join(work, "client")
+        dst = os.path.join(work, "pulled")
+        server_data = os.path.join(work, "server-data")
+        for d in (src, dst, server_data):
+            os.makedirs(d)
+        print(f"creating tree under {src}...", file=sys.stderr)
+        make_tree(src, args.small, args.small_size, args.huge, args.huge_mb, args.depth)
+        files, size = tree_size(src)
+
+        proc, port = start_server(work, certs, server_data, args.max_connections)
+        context = make_client_context(*certs["client"], certs["server"][0])
+        bench = Bench(args.verbose)
+
+        def transfer(local_dir, index):
+            session = open_session("127.0.0.1", port, context)
+            try:
+                actions = plan_actions(session, "127.0.0.1", port, context, local_dir, index=index, workers=args.workers)
+                return sync("127.0.0.1", port, context, local_dir, actions, session=session, max_concurrency=args.concurrency, stripes=args.stripes)
+            finally:
+                if session is not None:
+                    session.close()
+
+        def plan(local_dir, index):
+            with open_session("127.0.0.1", port, context) as session:
+                return plan_actions(session, "127.0.0.1", port, context, local_dir, index=index, workers=args.workers)
+
+        def listing():
+            with open_session("127.0.0.1", port, context) as session:
+                return sum(1 for e in session.iter_list())
+
+        src_index = HashIndex(src)
+        bench.run("scan", lambda: scan_dir(src, index=src_index, workers=args.workers), files, size)
+        bench.run("rescan", lambda: scan_dir(src, index=src_index, workers=args.workers), files, size)
+        bench.run("plan", lambda: plan(src, src_index), files)
+        results = bench.run("push", lambda: transfer(src, src_index), files, size)
+        failed = sum(1 for r in results if not r["ok"])
+        listed = bench.run("list", listing, files)
+        bench.run("plan_noop", lambda: plan(src, src_index), files)
+        dst_index = HashIndex(dst)
+        results = bench.run("pull", lambda: transfer(dst, dst_index), files, size)
+        failed += sum(1 for r in results if not r["ok"])
+        src_digests, dst_digests = tree_digests(src), tree_digests(dst)
+        mismatched = sorted(p for p in src_digests.keys() | dst_digests.keys() if src_digests.get(p) != dst_digests.get(p))
+        with open_session("127.0.0.1", port, context) as session:
+            server_metrics = session.metrics()
+        src_index.close()
+        dst_index.close()
+
+        stop_server(proc)
+        proc = None
+        report = {
+            "params": vars(args),
+            "tree": {"files": files, "bytes": size},
+            "phases": bench.phases,
+            "listed": listed,
+            "failed": failed,
+            "verified": not mismatched,
+            "mismatched": mismatched[:20],
+            "peak_rss_mb": {"client": peak_rss_mb(resource.RUSAGE_SELF), "server": peak_rss_mb(resource.RUSAGE_CHILDREN)},
+            "metrics": {"client": metrics.dump(), "server": server_metrics},
+        }
+        text = json.dumps(report, indent=2)
+        print(text)
+        if args.out:
+            with open(args.out, "w") as f:
+                f.write(text + "\n")
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        if args.keep:
+            print(f"kept {work}", file=sys.stderr)
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from sync_core import scan_dir, is_ignored
+
+
+def make_tree(root, files, per_dir=100):
+    # files spread over two levels of directories, per_dir files in each leaf
+    for i in range(files):
+        k = i // per_dir
+        d = os.path.join(root, f"a{k // 100:04d}", f"b{k % 100:02d}")
+        if i % per_dir == 0:
+            os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"f{i}.txt"), "wb") as f:
+            f.write(b"x" * (i % 64))
+
+
+def walk_scan(local_dir):
+    # the scanner this project used before: os.walk, relpath and two stats per file
+    abs_path = os.path.abspath(local_dir)
+    entries = []
+    for (root, dirs, files) in os.walk(abs_path):
+        for filename in files:
+            if is_ignored(filename):
+                continue
+            file_path = os.path.join(root, filename)
+            entries.append({
+                'path': os.path.relpath(file_path, abs_path),
+                'size': os.stat(file_path).st_size,
+                'mtime': os.stat(file_path).st_mtime,
+            })
+    return entries
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    n = len(fn())
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {n:>9} files {elapsed:8.2f}s {n / elapsed:12.0f} files/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare directory scanners on a synthetic tree")
+    parser.add_argument("--files", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--dir", help="existing tree to scan instead of generating one")
+    parser.add_argument("--keep", action="store_true", help="keep the generated tree")
+    args = parser.parse_args()
+
+    root = args.dir
+    if root is None:
+        root = tempfile.mkdtemp(prefix="filesync-scan-")
+        print(f"creating {args.files} files under {root}...")
+        make_tree(root, args.files)
+    try:
+        # first pass only warms the page cache so every scanner sees the same state
+        scan_dir(root, workers=args.workers)
+        base = timed("os.walk (old)", lambda: walk_scan(root))
+        seq = timed("scandir, 1 thread", lambda: scan_dir(root, workers=1))
+        par = timed(f"scandir, {args.workers} threads", lambda: scan_dir(root, workers=args.workers))
+        print(f"speedup over os.walk: {base / seq:.2f}x single-threaded, {base / par:.2f}x parallel")
+    finally:
+        if args.dir is None and not args.keep:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
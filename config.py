@@ -1,26 +1,195 @@
 import json 
 import os
+import signal
+import threading
+import time
+from hasher import HASH_WORKERS
 
 CONFIG_FILE = "sync_config.json"
 
+# expected type of every tunable; a value of the wrong type makes the whole
+# file invalid rather than failing somewhere deep in a sync
+TYPES = {
+    "local_dir": str,
+    "peer": dict,
+    "peer.host": str,
+    "peer.port": int,
+    "peers": list,
+    "certs": dict,
+    "server": dict,
+    "server.host": str,
+    "server.port": int,
+    "server.max_connections": int,
+    "server.max_long_polls": int,
+    "server.metrics_host": str,
+    "server.metrics_port": int,
+    "debounce_ms": (int, float),
+    "debounce_max_ms": (int, float),
+    "mtime_skew_sec": (int, float),
+    "max_concurrency": int,
+    "hash_index": bool,
+    "delta_min_size": int,
+    "batch_max_file": int,
+    "stripes": int,
+    "stripe_min_size": int,
+    "full_sync_interval_sec": (int, float),
+    "live_index": bool,
+    "watch_remote": bool,
+    "scan_workers": int,
+    "hash_workers": int,
+    "structured_logs": bool,
+    "transfer_priority": dict,
+    "transfer_priority.globs": list,
+    "transfer_priority.small_first": bool,
+    "transfer_priority.recent_first": bool,
+    "rate_limits": dict,
+    "rate_limits.up": (int, float),
+    "rate_limits.down": (int, float),
+    "rate_limits.peers": dict,
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
 def load_config():
     if not os.path.exists(CONFIG_FILE):
-        return FileNotFoundError(f"config file '{config_file}' does not exist.")
+        raise FileNotFoundError(f"config file '{CONFIG_FILE}' does not exist.")
     
     with open(CONFIG_FILE,"r") as f:
         config = json.load(f)
     
     return config
 
+
+def lookup(config, key, default=None):
+    # "server.port" style dotted keys into nested sections
+    value = config
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return default
+        value = value[part]
+    return value
+
+
+def validate(config):
+    if not isinstance(config, dict):
+        raise ConfigError("config must be a JSON object")
+    if "local_dir" not in config:
+        raise ConfigError("config has no 'local_dir'")
+    for key, expected in TYPES.items():
+        value = lookup(config, key)
+        if value is None:
+            continue
+        # bool is an int subclass, but true is never a valid port or size
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            names = " or ".join(t.__name__ for t in (expected if isinstance(expected, tuple) else (expected,)))
+            raise ConfigError(f"'{key}' must be {names}, got {value!r}")
+    for peer in config.get("peers") or []:
+        if not isinstance(peer, dict) or not isinstance(peer.get("host"), str) or not isinstance(peer.get("port"), int) or isinstance(peer.get("port"), bool):
+            raise ConfigError(f"every entry of 'peers' needs a host and a port, got {peer!r}")
+    return config
+
+
+class Config:
+    # the parsed config file, loaded once and reloaded when its mtime or size
+    # changes (checked at most every check_interval seconds) or on reload().
+    # a reload that fails to parse or validate keeps the previous settings.
+    def __init__(self, path=CONFIG_FILE, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.data = None
+        self.stamp = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def get(self):
+        if self.data is None or time.monotonic() - self.checked >= self.check_interval:
+            self.reload()
+        return self.data
+
+    def reload(self, force=False):
+        with self.lock:
+            self.checked = time.monotonic()
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                if self.data is None:
+                    raise FileNotFoundError(f"config file '{self.path}' does not exist.")
+                return self.data
+            stamp = (st.st_mtime_ns, st.st_size)
+            if not force and stamp == self.stamp:
+                return self.data
+            try:
+                with open(self.path, "r") as f:
+                    data = validate(json.load(f))
+            except (ValueError, OSError) as e:
+                if self.data is None:
+                    raise
+                print(f"config: keeping previous settings, '{self.path}' is invalid: {e}")
+                self.stamp = stamp
+                return self.data
+            first = self.data is None
+            self.data, self.stamp = data, stamp
+        if not first:
+            print(f"config: reloaded '{self.path}'")
+            for listener in list(self.listeners):
+                listener(data)
+        return data
+
+    def on_change(self, listener):
+        # listener(config) runs after every successful reload
+        self.listeners.append(listener)
+
+    def value(self, key, default=None):
+        return lookup(self.get(), key, default)
+
+    def get_int(self, key, default=0):
+        return int(self.value(key, default))
+
+    def get_float(self, key, default=0.0):
+        return float(self.value(key, default))
+
+    def get_bool(self, key, default=False):
+        return bool(self.value(key, default))
+
+    def get_str(self, key, default=""):
+        return str(self.value(key, default))
+
+
+CONFIG = Config()
+
+
+def reload_on_signal():
+    # SIGHUP forces a reload; only possible from the main thread on posix.
+    # the handler may interrupt the main thread while it holds CONFIG.lock,
+    # so the reload itself runs on a thread of its own
+    def reload_later(signum, frame):
+        threading.Thread(target=CONFIG.reload, kwargs={"force": True}, daemon=True).start()
+
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, reload_later)
+
 def save_config(config):
     with open(CONFIG_FILE, "w") as f:
         json.dump(config,f,indent=2)
 
     print(f"config saved to '{CONFIG_FILE}'")
+    CONFIG.reload(force=True)
 
 
 def get_config():
-    return load_config()
+    # shared, cached dict; treat it as read-only
+    return CONFIG.get()
+
+
+def peer_list(cfg):
+    # "peers" lists every machine to sync with; a lone "peer" is a list of one
+    if cfg.get("peers"):
+        return cfg["peers"]
+    return [cfg["peer"]] if "peer" in cfg else []
 
 def set_local_dir(path):
     config = load_config()
@@ -36,6 +205,15 @@ def set_peer(host,port):
     print(f"peer set to: {host}:{port}")
 
 
+def add_peer(host,port):
+    config = load_config()
+    peers = config.get("peers") or ([config["peer"]] if "peer" in config else [])
+    peers.append({"host":host,"port":int(port)})
+    config["peers"] = peers
+    save_config(config)
+    print(f"peer added: {host}:{port} ({len(peers)} peers)")
+
+
 def set_certs(cert,key,peer_cert):
     config = load_config()
     config['certs']['cert'] = os.path.abspath(cert)
@@ -50,6 +228,7 @@ def reset_config():
         "host":"192.168.1.101",
         "port":5555
     },
+    "peers":[],
     "certs":{
         "cert":"/home/vishal/sync_certs/linux.cert",
         "key":"/home/vishal/sync_certs/linux.key",
@@ -57,11 +236,37 @@ def reset_config():
     },
     "server":{
         "host":"0.0.0.0",
-        "port":5555
+        "port":5555,
+        "max_connections":16,
+        "max_long_polls":256,
+        "metrics_host":"127.0.0.1",
+        "metrics_port":9555
     },
     "debounce_ms":800,
+    "debounce_max_ms":5000,
     "mtime_skew_sec":2,
-    "max_concurrency":1
+    "max_concurrency":1,
+    "hash_index":True,
+    "delta_min_size":1048576,
+    "batch_max_file":65536,
+    "stripes":4,
+    "stripe_min_size":67108864,
+    "full_sync_interval_sec":300,
+    "live_index":True,
+    "watch_remote":True,
+    "scan_workers":1,
+    "hash_workers":HASH_WORKERS,
+    "structured_logs":False,
+    "transfer_priority":{
+        "globs":[],
+        "small_first":True,
+        "recent_first":True
+    },
+    "rate_limits":{
+        "up":0,
+        "down":0,
+        "peers":{}
+    }
 }
     save_config(default)
     print("config reset to defaults")
@@ -0,0 +1,175 @@
+import hashlib
+import math
+import zlib
+from protocol import CHUNK_SIZE, COPY, COPY_REF, DATA, END, ProtocolError, recv_frame, send_frame
+
+# rsync-style delta transfer. the receiver describes its copy as a list of
+# [weak, strong] block signatures; the sender walks its file with a rolling
+# adler-32 and answers with COPY references to matching blocks and DATA for
+# everything else, so only changed regions cross the wire.
+
+MOD = 65521
+READ_SIZE = 4 * 1024 * 1024
+# after this many bytes without a match stop rolling byte by byte and only
+# probe block-aligned offsets until something matches again
+ROLL_BUDGET = 8 * 1024 * 1024
+# a signature is sent as one message; past this many blocks (about 7 MiB of
+# JSON) blocks grow instead so it stays under protocol.MAX_FRAME
+MAX_BLOCKS = 128 * 1024
+
+
+def block_size_for(size):
+    block_size = max(4096, min(128 * 1024, int(math.sqrt(size)) // 1024 * 1024))
+    if size > block_size * MAX_BLOCKS:
+        block_size = -(-size // (MAX_BLOCKS * 1024)) * 1024
+    return block_size
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def signature(f, block_size):
+    blocks = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        blocks.append([zlib.adler32(block), strong_hash(block)])
+    return blocks
+
+
+def make_delta(f, blocks, block_size, sha):
+    # yields ("copy", first_block, count) and ("data", bytes) in file order and
+    # feeds every byte read from f into sha
+    table = {}
+    for i, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, {}).setdefault(strong, i)
+
+    data = b""
+    pos = 0
+    lit_start = 0
+    eof = False
+    fresh = True
+    rolled = 0
+    a = b = 0
+    copy = None
+
+    while True:
+        if not eof and len(data) - pos <= block_size:
+            chunk = f.read(READ_SIZE)
+            if chunk:
+                sha.update(chunk)
+                data = data[lit_start:] + chunk
+                pos -= lit_start
+                lit_start = 0
+            else:
+                eof = True
+        n = min(block_size, len(data) - pos)
+        if n <= 0:
+            break
+        if fresh:
+            weak = zlib.adler32(data[pos:pos + n])
+            a, b = weak & 0xffff, weak >> 16
+            fresh = False
+
+        candidates = table.get((b << 16) | a)
+        if candidates is not None:
+            idx = candidates.get(strong_hash(data[pos:pos + n]))
+            if idx is not None:
+                if pos > lit_start:
+                    if copy:
+                        yield ("copy", copy[0], copy[1])
+                        copy = None
+                    for i in range(lit_start, pos, CHUNK_SIZE):
+                        yield ("data", data[i:min(pos, i + CHUNK_SIZE)])
+                if copy and copy[0] + copy[1] == idx:
+                    copy[1] += 1
+                else:
+                    if copy:
+                        yield ("copy", copy[0], copy[1])
+                    copy = [idx, 1]
+                pos += n
+                lit_start = pos
+                fresh = True
+                rolled = 0
+                continue
+
+        if n < block_size or pos + n >= len(data):
+            # short tail of the file, nothing left to roll into
+            pos = len(data)
+        elif rolled >= ROLL_BUDGET:
+            pos += n
+            fresh = True
+        else:
+            out = data[pos]
+            a = (a - out + data[pos + n]) % MOD
+            b = (b - n * out + a - 1) % MOD
+            pos += 1
+            rolled += 1
+
+        if pos - lit_start >= CHUNK_SIZE:
+            if copy:
+                yield ("copy", copy[0], copy[1])
+                copy = None
+            for i in range(lit_start, pos, CHUNK_SIZE):
+                yield ("data", data[i:min(pos, i + CHUNK_SIZE)])
+            lit_start = pos
+
+    if copy:
+        yield ("copy", copy[0], copy[1])
+    for i in range(lit_start, len(data), CHUNK_SIZE):
+        yield ("data", data[i:min(len(data), i + CHUNK_SIZE)])
+
+
+def send_delta(sock, f, blocks, block_size, rid):
+    sha = hashlib.sha256()
+    literal = copied = 0
+    for op in make_delta(f, blocks, block_size, sha):
+        if op[0] == "copy":
+            send_frame(sock, COPY, rid, COPY_REF.pack(op[1], op[2]))
+            copied += op[2] * block_size
+        else:
+            send_frame(sock, DATA, rid, op[1])
+            literal += len(op[1])
+    send_frame(sock, END, rid, sha.hexdigest().encode("ascii"))
+    return literal, copied
+
+
+def recv_delta(rfile, rid, basis, out, block_size, buf=None):
+    # rebuilds the sender's file into out from DATA frames and COPY references
+    # into basis; returns (size, sha-256 of what was written, sender's sha-256).
+    # the stream is always read to END so the connection stays usable.
+    if buf is None:
+        buf = bytearray(CHUNK_SIZE)
+    sha = hashlib.sha256()
+    size = 0
+    while True:
+        frame = recv_frame(rfile, buf)
+        if frame is None:
+            raise ConnectionError("connection closed in the middle of a delta")
+        ftype, frame_rid, payload = frame
+        if frame_rid != rid:
+            raise ProtocolError(f"frame for request {frame_rid} while receiving {rid}")
+        if ftype == END:
+            return size, sha.hexdigest(), bytes(payload).decode("ascii")
+        if ftype == DATA:
+            out.write(payload)
+            sha.update(payload)
+            size += len(payload)
+        elif ftype == COPY:
+            first, count = COPY_REF.unpack(payload)
+            if basis is None:
+                continue
+            basis.seek(first * block_size)
+            remaining = count * block_size
+            while remaining > 0:
+                block = basis.read(min(remaining, READ_SIZE))
+                if not block:
+                    break
+                out.write(block)
+                sha.update(block)
+                size += len(block)
+                remaining -= len(block)
+        else:
+            raise ProtocolError(f"unexpected frame type {ftype} in delta stream")
@@ -0,0 +1,301 @@
+import os
+import queue
+import threading
+import metrics
+from protocol import CHUNK_SIZE, Compressor, choose_codec, count_compression
+from sync_core import SCAN_WORKERS
+from tls_client import open_session, scan_local, plan_remote, action_path
+from transfer import (
+    sync, has_work, is_error, job_priority, DEFAULT_PRIORITY,
+    DELTA_MIN_SIZE, BATCH_MAX_FILE, STRIPES, STRIPE_MIN_SIZE,
+)
+
+# one folder synced with several peers. the tree is scanned (and hashed) once
+# and planned against every peer in parallel. a file more than one peer needs
+# is read from disk once and every chunk is written to all of their sessions;
+# everything else (pulls, moves, deltas, files only one peer needs) runs on a
+# transfer engine per peer. a peer that fails drops out without holding up
+# the others, and whatever it didn't confirm is retried on its own engine.
+
+# chunks buffered per peer before the reader waits for the slowest one
+FANOUT_QUEUE = 64
+
+
+def peer_name(peer):
+    return f"{peer['host']}:{peer['port']}"
+
+
+class PeerStream:
+    # one peer's side of the fan-out: a thread writing the chunks it is handed
+    # to that peer's session, with replies pipelined as in submit_push
+    def __init__(self, name, session, progress=None):
+        self.name = name
+        self.session = session
+        self.progress = progress
+        self.queue = queue.Queue(maxsize=FANOUT_QUEUE)
+        self.error = None
+        self.done = set()
+        self.results = []
+        self.rid = None
+        self.path = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _emit(self, event, path, **fields):
+        if self.progress is not None:
+            self.progress({"event": event, "kind": "push", "path": path, "peer": self.name, **fields})
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep taking chunks so the reader never blocks on a dead peer
+                continue
+            try:
+                self._handle(item)
+            except Exception as e:
+                self.error = str(e)
+                print(f"{self.name}: fan-out stopped ({e})")
+        if self.error is None:
+            try:
+                self._collect(self.session.drain(0))
+            except Exception as e:
+                self.error = str(e)
+
+    def _handle(self, item):
+        op = item[0]
+        if op == "begin":
+            _, self.path, size, mtime, codec = item
+            self.rid, replies = self.session.open_push(self.path, size, mtime, codec)
+            self._collect(replies)
+            self._emit("start", self.path, size=size)
+        elif op == "data":
+            self.session.push_chunk(self.rid, item[1])
+            if item[2]:
+                self._emit("bytes", self.path, bytes=item[2])
+        else:
+            self._collect(self.session.close_push(self.rid, self.path, item[1]))
+
+    def _collect(self, replies):
+        for kind, path, resp in replies:
+            if is_error(resp):
+                # goes back to this peer's own engine, which reports it
+                self._emit("done", path, ok=True, split=True)
+                continue
+            self.done.add(path)
+            self.results.append({"kind": "push", "path": path, "ok": True, "error": None, "attempts": 1})
+            metrics.inc("filesync_files_total", kind="push", result="ok")
+            self._emit("done", path, ok=True)
+
+
+def send_shared(path, local_dir, streams, buf, cancel):
+    local_file = os.path.join(local_dir, path)
+    try:
+        f = open(local_file, "rb")
+    except OSError:
+        # left unconfirmed, so each peer's engine reports it
+        return 0
+    with f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        # compressed once, so only when every peer negotiated the same codec
+        codecs = set(s.session.codec for s in streams)
+        codec = choose_codec(path, f, size, codecs.pop() if len(codecs) == 1 else None)
+        print(f"Push:{path} to {len(streams)} peers")
+        for s in streams:
+            s.put(("begin", path, size, st.st_mtime, codec))
+        comp = Compressor(codec) if codec else None
+        view = memoryview(buf)
+        sent = wire = 0
+        while sent < size and not cancel.is_set():
+            n = f.readinto(view[:min(len(buf), size - sent)])
+            if not n:
+                break
+            sent += n
+            data = bytes(view[:n])
+            if comp is not None:
+                data = comp.compress(data)
+                wire += len(data)
+            if data:
+                for s in streams:
+                    s.put(("data", data, n))
+        if comp is not None:
+            tail = comp.finish()
+            wire += len(tail)
+            for s in streams:
+                s.put(("data", tail, 0))
+            count_compression(sent, wire)
+    # a short stream (file shrank, cancelled) ends early and the peers reject it
+    for s in streams:
+        s.put(("end", local_file))
+    return sent
+
+
+def plan_peer(peer, context, l_files, gone, paths, skew_sec):
+    host, port = peer["host"], peer["port"]
+    session = open_session(host, port, context)
+    remote = set()
+    try:
+        actions = plan_remote(session, host, port, context, l_files, gone, paths, skew_sec, remote_paths=remote)
+    except Exception:
+        if session is not None:
+            session.close()
+        raise
+    return {"peer": peer, "session": session, "actions": actions, "remote": remote}
+
+
+def plan_peers(peers, context, l_files, gone, paths, skew_sec):
+    plans = {}
+
+    def run(peer):
+        try:
+            plans[peer_name(peer)] = plan_peer(peer, context, l_files, gone, paths, skew_sec)
+        except Exception as e:
+            print(f"{peer_name(peer)}: planning failed ({e}), skipping it this round")
+
+    threads = [threading.Thread(target=run, args=(peer,), daemon=True) for peer in peers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return plans
+
+
+def dedupe_pulls(plans):
+    # a path several peers would send us comes from the one with the newest
+    # copy, and no peer is pushed a path that is being replaced locally
+    best = {}
+    for name, plan in plans.items():
+        for kind in ("pull", "copy_local"):
+            for a in plan["actions"][kind]:
+                mtime = a.get("mtime", 0) if isinstance(a, dict) else 0
+                p = action_path(a)
+                if p not in best or mtime > best[p][1]:
+                    best[p] = (name, mtime)
+    for name, plan in plans.items():
+        actions = plan["actions"]
+        for kind in ("pull", "copy_local"):
+            actions[kind] = [a for a in actions[kind] if best[action_path(a)][0] == name]
+        actions["push"] = [a for a in actions["push"] if action_path(a) not in best]
+
+
+def split_shared(plans, delta_min_size):
+    # {path: (entry, peer names)} for pushes at least two peers need. a large
+    # file a peer already has stays with that peer so it can go as a delta
+    wanted = {}
+    for name, plan in plans.items():
+        if plan["session"] is None:
+            continue
+        for a in plan["actions"]["push"]:
+            if delta_min_size and a["size"] >= delta_min_size and a["path"] in plan["remote"]:
+                continue
+            wanted.setdefault(a["path"], (a, []))[1].append(name)
+    shared = {p: w for p, w in wanted.items() if len(w[1]) > 1}
+    for name, plan in plans.items():
+        plan["actions"]["push"] = [a for a in plan["actions"]["push"]
+                                   if a["path"] not in shared or name not in shared[a["path"]][1]]
+    return shared
+
+
+def stream_shared(shared, plans, local_dir, priority, progress, cancel):
+    # returns {peer: results} and puts every push a peer didn't confirm back
+    # into that peer's actions
+    names = sorted(set(n for _, peers in shared.values() for n in peers))
+    streams = {n: PeerStream(n, plans[n]["session"], progress) for n in names}
+    rules = dict(DEFAULT_PRIORITY, **(priority or {}))
+    order = sorted(shared.items(), key=lambda kv: job_priority(
+        {"kind": "push", "path": kv[0], "size": kv[1][0]["size"], "mtime": kv[1][0]["mtime"]}, rules))
+    buf = bytearray(CHUNK_SIZE)
+    read = copies = 0
+    for path, (entry, peers) in order:
+        if cancel.is_set():
+            break
+        live = [streams[n] for n in peers if streams[n].error is None]
+        if live:
+            sent = send_shared(path, local_dir, live, buf, cancel)
+            read += sent
+            copies += sent * len(live)
+    for s in streams.values():
+        s.finish()
+    for path, (entry, peers) in shared.items():
+        for n in peers:
+            if path not in streams[n].done:
+                plans[n]["actions"]["push"].append(entry)
+    for n, s in streams.items():
+        if s.error is not None:
+            # the session is in an unknown state; the engine opens a new one
+            plans[n]["session"].close()
+            plans[n]["session"] = None
+    print(f"fan-out: {len(shared)} files, {read} bytes read once for {copies} bytes sent to {len(names)} peers")
+    return {n: s.results for n, s in streams.items()}
+
+
+def sync_peers(peers, context, local_dir, index=None, paths=None, skew_sec=2.0, workers=SCAN_WORKERS,
+               max_concurrency=1, delta_min_size=DELTA_MIN_SIZE, batch_max_file=BATCH_MAX_FILE,
+               priority=None, stripes=STRIPES, stripe_min_size=STRIPE_MIN_SIZE, progress=None, cancel=None):
+    # returns {peer name: results}; progress events carry a "peer" field
+    cancel = cancel or threading.Event()
+    with metrics.timed(phase="plan"):
+        l_files, gone = scan_local(local_dir, index, paths, workers)
+        plans = plan_peers(peers, context, l_files, gone, paths, skew_sec)
+    results = {name: [] for name in plans}
+    try:
+        if not any(has_work(plan["actions"]) for plan in plans.values()):
+            print("No changes to sync.")
+            return results
+        dedupe_pulls(plans)
+        shared = split_shared(plans, delta_min_size)
+
+        def run_engine(name, actions, session):
+            plan = plans[name]
+            if not has_work(actions):
+                return
+            peer_progress = None
+            if progress is not None:
+                peer_progress = lambda event: progress(dict(event, peer=name))
+            try:
+                results[name] += sync(plan["peer"]["host"], plan["peer"]["port"], context, local_dir, actions,
+                                      session=session, max_concurrency=max_concurrency, delta_min_size=delta_min_size,
+                                      batch_max_file=batch_max_file, progress=peer_progress, cancel=cancel,
+                                      priority=priority, stripes=stripes, stripe_min_size=stripe_min_size,
+                                      index=index)
+            except Exception as e:
+                print(f"{name}: sync failed ({e})")
+
+        # each peer's own work runs on its own connections alongside the fan-out;
+        # plan["actions"] then collects what the fan-out hands back
+        threads = []
+        for name, plan in plans.items():
+            actions, plan["actions"] = plan["actions"], {kind: [] for kind in plan["actions"]}
+            session = None if shared else plan["session"]
+            threads.append(threading.Thread(target=run_engine, args=(name, actions, session), daemon=True))
+        for t in threads:
+            t.start()
+        if shared:
+            with metrics.timed(phase="fanout"):
+                for name, done in stream_shared(shared, plans, local_dir, priority, progress, cancel).items():
+                    results[name] += done
+        for t in threads:
+            t.join()
+        # pushes the fan-out couldn't deliver
+        for name, plan in plans.items():
+            if has_work(plan["actions"]):
+                print(f"{name}: retrying {len(plan['actions']['push'])} pushes on its own")
+                run_engine(name, plan["actions"], plan["session"])
+    finally:
+        for plan in plans.values():
+            if plan["session"] is not None:
+                plan["session"].close()
+    for name, res in results.items():
+        failed = sum(1 for r in res if not r["ok"])
+        print(f"{name}: {len(res) - failed} files done, {failed} failed")
+    return results
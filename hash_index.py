@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import threading
+from sync_core import INDEX_FILE
+from hasher import HASH_WORKERS, hash_file, hash_many
+
+
+class HashIndex:
+    # sha-256 digests cached on disk, keyed by path and validated against
+    # inode, size and mtime so only files whose stat changed are rehashed
+    def __init__(self, local_dir, db_path=None, workers=HASH_WORKERS):
+        self.local_dir = os.path.abspath(local_dir)
+        self.workers = workers
+        self.db_path = db_path or os.path.join(self.local_dir, INDEX_FILE)
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime_ns INTEGER, hash TEXT)"
+        )
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.hashed = 0
+        # paths the last full scan found gone, i.e. deleted or moved locally
+        self.removed = []
+
+    def lookup(self, rel_path, st):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT ino, size, mtime_ns, hash FROM files WHERE path = ?", (rel_path,)
+            ).fetchone()
+        if row and row[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return row[3]
+        return None
+
+    def store(self, rel_path, st, digest):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (path, ino, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                (rel_path, st.st_ino, st.st_size, st.st_mtime_ns, digest),
+            )
+
+    def digest(self, rel_path, abs_path, st=None):
+        if st is None:
+            st = os.stat(abs_path)
+        cached = self.lookup(rel_path, st)
+        if cached is not None:
+            return cached
+        digest = hash_file(abs_path)
+        self.store(rel_path, st, digest)
+        self.hashed += 1
+        return digest
+
+    def digest_many(self, files):
+        # (rel_path, abs_path, st) in, ((rel_path, abs_path, st), digest) out
+        # as each is ready; misses are hashed on `workers` threads and stored.
+        # digest is None for a file that couldn't be read
+        fresh = set()
+
+        def cached(f):
+            digest = self.lookup(f[0], f[2])
+            if digest is None:
+                fresh.add(f[0])
+            return digest
+
+        for f, digest in hash_many(((f, f[1]) for f in files), self.workers, cached):
+            if f[0] in fresh:
+                fresh.discard(f[0])
+                if digest is not None:
+                    self.store(f[0], f[2], digest)
+                    self.hashed += 1
+            yield f, digest
+
+    def finish_scan(self, seen_paths):
+        # forget files that disappeared since the last full scan
+        seen = set(seen_paths)
+        with self.lock:
+            known = [row[0] for row in self.db.execute("SELECT path FROM files")]
+            gone = [(p,) for p in known if p not in seen]
+            if gone:
+                self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+            self.db.commit()
+        if self.hashed or gone:
+            print(f"hash index: {self.hashed} files rehashed, {len(gone)} removed")
+        self.hashed = 0
+        self.removed = [p for (p,) in gone]
+
+    def drop(self, rel_paths):
+        # forgets these paths and returns the ones that were known
+        with self.lock:
+            known = [p for p in rel_paths
+                     if self.db.execute("SELECT 1 FROM files WHERE path = ?", (p,)).fetchone()]
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in known])
+            self.db.commit()
+        return known
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def open_index(cfg, local_dir=None):
+    if not cfg.get("hash_index", True):
+        return None
+    return HashIndex(local_dir or cfg["local_dir"], workers=cfg.get("hash_workers", HASH_WORKERS))
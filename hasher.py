@@ -0,0 +1,94 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+# sha-256 of whole files for scans and the hash index. hashlib releases the
+# GIL while it digests a large buffer, so files spread over a thread pool are
+# hashed on several cores at once; each thread reads into its own 1 MiB
+# buffer instead of allocating small chunks. files are read, not mmap'ed: a
+# file truncated while mapped kills the process with SIGBUS, and files in a
+# synced folder change under us all the time.
+
+# files hashed at once by hash_many; config key hash_workers
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+# read size per call
+HASH_BUF = 1024 * 1024
+
+local = threading.local()
+
+
+def thread_buffer():
+    buf = getattr(local, "buf", None)
+    if buf is None:
+        buf = local.buf = bytearray(HASH_BUF)
+    return buf
+
+
+def hash_file(path, buf=None):
+    if buf is None:
+        buf = thread_buffer()
+    view = memoryview(buf)
+    sha = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            sha.update(view[:n])
+    return sha.hexdigest()
+
+
+def copy_hashed(src, dst, buf=None):
+    # copies src to dst and returns the sha-256 of exactly the bytes copied
+    if buf is None:
+        buf = thread_buffer()
+    view = memoryview(buf)
+    sha = hashlib.sha256()
+    with open(src, "rb", buffering=0) as fin, open(dst, "wb") as fout:
+        while True:
+            n = fin.readinto(buf)
+            if not n:
+                break
+            sha.update(view[:n])
+            fout.write(view[:n])
+    return sha.hexdigest()
+
+
+def try_hash(path):
+    try:
+        return hash_file(path)
+    except OSError:
+        return None
+
+
+def hash_many(items, workers=HASH_WORKERS, cached=None):
+    # items are (key, path) pairs and are consumed lazily. yields (key, digest)
+    # as each digest is ready, so not in input order; digest is None for a
+    # file that couldn't be read. cached(key) may return a digest that is
+    # already known, which is then yielded without reading the file.
+    if workers <= 1:
+        for key, path in items:
+            digest = cached(key) if cached is not None else None
+            yield key, digest if digest is not None else try_hash(path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for key, path in items:
+            digest = cached(key) if cached is not None else None
+            if digest is not None:
+                yield key, digest
+                continue
+            pending[pool.submit(try_hash, path)] = key
+            # a few files queued per thread is enough to keep them all busy
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield pending.pop(fut), fut.result()
+        for fut in as_completed(list(pending)):
+            yield pending.pop(fut), fut.result()
@@ -0,0 +1,202 @@
+import os
+import threading
+from collections import deque
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from sync_core import CHANGE_EVENTS, is_ignored, iter_entries, iter_scan, scan_paths, SCAN_WORKERS
+
+# change records kept for changes_since(); a client whose cursor has fallen
+# further behind than this has to reconcile in full
+JOURNAL_SIZE = 100000
+
+
+class LiveIndex(FileSystemEventHandler):
+    # the server's listing of local_dir, held in memory and kept current by a
+    # watchdog observer. the tree is walked once at startup (or on rescan());
+    # after that only the files and directories named in events are looked at
+    # again. every add, modify, delete and rename is journaled under the next
+    # sequence number, `generation` is the latest one, and the entry list
+    # handed to clients is built at most once per generation. every function
+    # in `listeners` is called, without arguments and outside the lock, after
+    # each batch of changes and on stop().
+    def __init__(self, local_dir, index=None, workers=SCAN_WORKERS, settle_sec=0.2):
+        super().__init__()
+        self.local_dir = os.path.abspath(local_dir)
+        self.index = index
+        self.workers = workers
+        self.settle_sec = settle_sec
+        self.entries = {}
+        self.generation = 0
+        # cursors only make sense against the process that issued them
+        self.epoch = os.urandom(8).hex()
+        self.journal = deque(maxlen=JOURNAL_SIZE)
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.stopped = False
+        self._update_lock = threading.Lock()
+        self._listing = None
+        self._dirty = set()
+        self._dirty_dirs = set()
+        self._moves = {}
+        self._timer = None
+        self._observer = None
+
+    def start(self):
+        self.entries = {e["path"]: e for e in iter_entries(self.local_dir, index=self.index, workers=self.workers)}
+        self._observer = Observer()
+        self._observer.schedule(self, self.local_dir, recursive=True)
+        self._observer.daemon = True
+        self._observer.start()
+        print(f"live index: watching {self.local_dir}, {len(self.entries)} files")
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+        self._notify()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def rescan(self):
+        with self._update_lock:
+            found = {e["path"]: e for e in iter_entries(self.local_dir, index=self.index, workers=self.workers)}
+            with self.lock:
+                removed = [p for p in self.entries if p not in found]
+            self._commit(removed, found)
+        return self.generation
+
+    def _commit(self, removed, found, moves=None):
+        # applies one batch of changes and journals each of them. moves maps
+        # new path -> old path; a pair whose old path went away in the same
+        # batch is recorded as a rename instead of a delete and an add.
+        moves = moves or {}
+        with self.lock:
+            removed = set(p for p in removed if p in self.entries)
+            renamed = {new: old for new, old in moves.items() if old in removed and new in found}
+            removed -= set(renamed.values())
+            for p in sorted(removed):
+                del self.entries[p]
+                self._record("delete", p)
+            for p, e in found.items():
+                if p in renamed:
+                    del self.entries[renamed[p]]
+                    self.entries[p] = e
+                    self._record("rename", p, e, renamed[p])
+                elif self.entries.get(p) != e:
+                    op = "modify" if p in self.entries else "add"
+                    self.entries[p] = e
+                    self._record(op, p, e)
+        self._notify()
+
+    def _notify(self):
+        for fn in list(self.listeners):
+            fn()
+
+    def _record(self, op, path, entry=None, old_path=None):
+        self.generation += 1
+        rec = {"seq": self.generation, "op": op, "path": path}
+        if entry is not None:
+            rec["entry"] = entry
+        if old_path is not None:
+            rec["from"] = old_path
+        self.journal.append(rec)
+        self._listing = None
+
+    def snapshot(self):
+        # (generation, entries); the list is shared, callers must not modify it
+        with self.lock:
+            if self._listing is None:
+                self._listing = list(self.entries.values())
+            return self.generation, self._listing
+
+    def _since(self, cursor):
+        oldest = self.journal[0]["seq"] - 1 if self.journal else self.generation
+        if cursor is None or cursor < oldest or cursor > self.generation:
+            return None
+        return [r for r in self.journal if r["seq"] > cursor]
+
+    def changes_since(self, cursor):
+        # records after `cursor`; None means the cursor is unknown or too old
+        # to answer from
+        with self.lock:
+            return self._since(cursor)
+
+    def update(self, rel_paths, moves=None):
+        # re-stats the given files now, e.g. right after the server wrote them,
+        # so a list that follows doesn't wait for the observer
+        rel_paths = set(rel_paths)
+        with self._update_lock:
+            found = {e["path"]: e for e in scan_paths(self.local_dir, rel_paths, index=self.index)}
+            self._commit([p for p in rel_paths if p not in found], found, moves)
+
+    def update_dirs(self, rel_dirs, moves=None):
+        # a directory appeared, vanished or moved: replace everything under it
+        moves = moves or {}
+        with self._update_lock:
+            scanned = []
+            file_moves = {}
+            for d in rel_dirs:
+                abs_dir = os.path.join(self.local_dir, d)
+                if not os.path.isdir(abs_dir):
+                    continue
+                for rel_path, file_path, st in iter_scan(abs_dir, self.workers):
+                    p = os.path.join(d, rel_path)
+                    scanned.append((p, file_path, st))
+                    if d in moves:
+                        file_moves[p] = os.path.join(moves[d], rel_path)
+            # a burst of new files is hashed on the index's pool, as in a scan
+            if self.index is not None:
+                hashed = self.index.digest_many(scanned)
+            else:
+                hashed = ((f, None) for f in scanned)
+            found = {}
+            for (p, file_path, st), digest in hashed:
+                found[p] = {"path": p, "size": st.st_size, "mtime": st.st_mtime}
+                if digest is not None:
+                    found[p]["hash"] = digest
+            if self.index is not None:
+                self.index.commit()
+            # only what is gone; files still there are compared with their
+            # entries by _commit and journaled only if they changed
+            prefixes = tuple(d + os.sep for d in rel_dirs)
+            with self.lock:
+                removed = [p for p in self.entries if p.startswith(prefixes) and p not in found]
+            self._commit(removed, found, file_moves)
+
+    def on_any_event(self, event):
+        if event.event_type not in CHANGE_EVENTS:
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", ""):
+            paths.append(event.dest_path)
+        rel = [os.path.relpath(p, self.local_dir) for p in paths]
+        with self.lock:
+            if event.is_directory:
+                if event.event_type == "modified":
+                    return
+                self._dirty_dirs.update(r for r in rel if r != ".")
+            else:
+                rel = [r for r in rel if not is_ignored(os.path.basename(r))]
+                self._dirty.update(rel)
+            if event.event_type == "moved" and len(rel) == 2:
+                self._moves[rel[1]] = rel[0]
+            if self._timer is None:
+                self._timer = threading.Timer(self.settle_sec, self._apply)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _apply(self):
+        with self.lock:
+            paths, dirs, moves = self._dirty, self._dirty_dirs, self._moves
+            self._dirty, self._dirty_dirs, self._moves = set(), set(), {}
+            self._timer = None
+        try:
+            if dirs:
+                self.update_dirs(dirs, moves)
+            if paths:
+                self.update(paths, moves)
+        except Exception as e:
+            print(f"live index: update failed ({e}), rescanning")
+            self.rescan()
@@ -0,0 +1,116 @@
+import hashlib
+import os
+
+# per-directory hash tree over scan entries. a directory's hash covers the
+# name, size, whole-second mtime and content hash of its files and the hashes
+# of its subdirectories, so two peers whose root hashes match have nothing
+# to exchange and a difference can be chased down one level per round trip.
+
+
+def new_node():
+    return {"files": {}, "dirs": set(), "hash": None}
+
+
+def depth(d):
+    return d.count(os.sep) + 1 if d else 0
+
+
+def build_tree(entries):
+    nodes = {"": new_node()}
+    for e in entries:
+        d = os.path.dirname(e["path"])
+        nodes.setdefault(d, new_node())["files"][os.path.basename(e["path"])] = e
+        child = d
+        while child:
+            parent = os.path.dirname(child)
+            pnode = nodes.setdefault(parent, new_node())
+            name = os.path.basename(child)
+            if name in pnode["dirs"]:
+                break
+            pnode["dirs"].add(name)
+            child = parent
+
+    for d in sorted(nodes, key=depth, reverse=True):
+        node = nodes[d]
+        h = hashlib.sha256()
+        for name in sorted(node["files"]):
+            e = node["files"][name]
+            line = f"f\0{name}\0{e['size']}\0{int(e['mtime'])}\0{e.get('hash', '')}\n"
+            h.update(line.encode("utf-8", "surrogateescape"))
+        for name in sorted(node["dirs"]):
+            line = f"d\0{name}\0{nodes[os.path.join(d, name)]['hash']}\n"
+            h.update(line.encode("utf-8", "surrogateescape"))
+        node["hash"] = h.hexdigest()
+    return nodes
+
+
+def iter_subtree(nodes, d):
+    stack = [d]
+    while stack:
+        cur = stack.pop()
+        node = nodes[cur]
+        yield from node["files"].values()
+        stack.extend(os.path.join(cur, name) for name in node["dirs"])
+
+
+def subtree_entries(nodes, d):
+    return list(iter_subtree(nodes, d))
+
+
+def describe(nodes, d, peer_hash):
+    # server side answer for one directory the client asked about: the reply
+    # for it and the file entries that go with it. the entries are produced
+    # lazily so the caller can stream them instead of building one big reply
+    node = nodes.get(d)
+    if node is None:
+        return {"missing": True}, ()
+    if peer_hash == node["hash"]:
+        return {"same": True}, ()
+    if peer_hash is None:
+        # the client has nothing here, so send the whole subtree at once
+        return {"hash": node["hash"], "dirs": {}}, iter_subtree(nodes, d)
+    dirs = {name: nodes[os.path.join(d, name)]["hash"] for name in node["dirs"]}
+    return {"hash": node["hash"], "dirs": dirs}, node["files"].values()
+
+
+def reconcile(session, local_entries):
+    # walks both trees top-down, descending only into directories whose hashes
+    # differ. returns the local and remote entries that still need comparing,
+    # or None if the server can't answer tree requests.
+    local = build_tree(local_entries)
+    l_out, r_out = [], []
+    queue = [["", local[""]["hash"]]]
+    fresh = True
+    rounds = 0
+    while queue:
+        reply = session.tree_diff(queue, fresh)
+        if reply is None:
+            return None
+        reply, files = reply
+        r_out.extend(files)
+        fresh = False
+        rounds += 1
+        next_queue = []
+        for d, local_hash in queue:
+            remote = reply[d]
+            if remote.get("same"):
+                continue
+            if remote.get("missing"):
+                l_out.extend(subtree_entries(local, d))
+                continue
+            if local_hash is None:
+                continue
+            lnode = local[d]
+            l_out.extend(lnode["files"].values())
+            for name, remote_hash in remote["dirs"].items():
+                sub = os.path.join(d, name)
+                if name not in lnode["dirs"]:
+                    next_queue.append([sub, None])
+                elif local[sub]["hash"] != remote_hash:
+                    next_queue.append([sub, local[sub]["hash"]])
+            for name in lnode["dirs"]:
+                if name not in remote["dirs"]:
+                    l_out.extend(subtree_entries(local, os.path.join(d, name)))
+        queue = next_queue
+    print(f"tree reconcile: {rounds} round trips, {len(l_out)} local / {len(r_out)} remote entries to compare")
+    return l_out, r_out
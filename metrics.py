@@ -0,0 +1,159 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# process-wide counters, gauges and histograms. every module records into the
+# same registry; the server exposes it as Prometheus text and JSON over HTTP,
+# and dump() gives the same numbers to anything else. structured logging, when
+# turned on, prints one JSON object per event next to the usual output.
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HELP = {
+    "filesync_bytes_total": "Payload bytes moved through framed connections",
+    "filesync_frames_total": "Frames sent and received",
+    "filesync_files_total": "Files handled by transfer jobs, by kind and result",
+    "filesync_scanned_files_total": "Files visited by directory scans",
+    "filesync_phase_seconds": "Time spent in each sync phase",
+    "filesync_tls_handshake_seconds": "TLS handshake time",
+    "filesync_request_seconds": "Server time per request, by request type",
+    "filesync_queue_depth": "Items waiting in a queue",
+    "filesync_connections": "Open server connections by state",
+    "filesync_watch_events_total": "File system events seen by the watcher",
+    "filesync_throttled_seconds_total": "Time transfers waited on a rate limit, by peer and direction",
+    "filesync_watch_echoes_total": "Watcher paths dropped because they only changed by our own pulls",
+}
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+structured = False
+
+
+def key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    k = key(name, labels)
+    with lock:
+        counters[k] = counters.get(k, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[key(name, labels)] = value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    k = key(name, labels)
+    with lock:
+        h = histograms.get(k)
+        if h is None:
+            h = histograms[k] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(h["buckets"]):
+            if value <= bound:
+                h["counts"][i] += 1
+                break
+        h["sum"] += value
+        h["count"] += 1
+
+
+@contextmanager
+def timed(name="filesync_phase_seconds", **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed, **labels)
+        log_event("timing", metric=name, seconds=round(elapsed, 6), **labels)
+
+
+def log_event(event, **fields):
+    if structured:
+        line = json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str)
+        print(line, file=sys.stderr, flush=True)
+
+
+def configure(cfg):
+    global structured
+    structured = bool(cfg.get("structured_logs", False))
+
+
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_prometheus():
+    lines = []
+    with lock:
+        families = {}
+        for kind, store in (("counter", counters), ("gauge", gauges), ("histogram", histograms)):
+            for (name, labels), value in store.items():
+                families.setdefault((name, kind), []).append((labels, value))
+        for (name, kind), series in sorted(families.items()):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series):
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                running = 0
+                for bound, n in zip(value["buckets"], value["counts"]):
+                    running += n
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {running}")
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def dump():
+    def series(store, fn):
+        return [{"name": name, "labels": dict(labels), **fn(value)} for (name, labels), value in sorted(store.items())]
+
+    with lock:
+        return {
+            "counters": series(counters, lambda v: {"value": v}),
+            "gauges": series(gauges, lambda v: {"value": v}),
+            "histograms": series(histograms, lambda h: {
+                "count": h["count"], "sum": round(h["sum"], 6),
+                "buckets": dict(zip(map(str, h["buckets"]), h["counts"])),
+            }),
+        }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, ctype = render_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, ctype = json.dumps(dump()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host, port):
+    # plain http on its own thread; returns the server so it can be shut down
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
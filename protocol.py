@@ -0,0 +1,373 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+import metrics
+import ratelimit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# every frame starts with a fixed header: frame type, request id, payload length
+HEADER = struct.Struct("!BII")
+
+MSG = 1   # utf-8 JSON control message
+DATA = 2  # raw file bytes
+END = 3   # end of a DATA stream; a delta stream puts the file's sha-256 here
+COPY = 4  # delta stream: reuse blocks of the receiver's copy, payload is COPY_REF
+
+FRAME_TYPES = (MSG, DATA, END, COPY)
+COPY_REF = struct.Struct("!II")  # first block index, block count
+CHUNK_SIZE = 64 * 1024
+# largest payload a peer may announce. the biggest legitimate frames are a
+# delta signature (capped by delta.MAX_BLOCKS), a page of journal records and
+# a compressed listing batch, all well under this; anything larger is refused
+# before a buffer is allocated for it
+MAX_FRAME = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def read_exact(rfile, view):
+    got = 0
+    while got < len(view):
+        n = rfile.readinto(view[got:])
+        if not n:
+            raise ConnectionError(f"connection closed after {got} of {len(view)} bytes")
+        got += n
+
+
+def send_frame(sock, ftype, rid, payload=b""):
+    ratelimit.charge(sock, len(payload))
+    sock.sendall(HEADER.pack(ftype, rid, len(payload)) + payload)
+    metrics.inc("filesync_frames_total", direction="sent")
+    metrics.inc("filesync_bytes_total", len(payload), direction="sent")
+
+
+def send_msg(sock, msg, rid=0):
+    send_frame(sock, MSG, rid, json.dumps(msg).encode("utf-8"))
+
+
+def recv_frame(rfile, buf=None):
+    header = bytearray(HEADER.size)
+    n = rfile.readinto(header)
+    if not n:
+        return None
+    if n < HEADER.size:
+        read_exact(rfile, memoryview(header)[n:])
+    ftype, rid, length = HEADER.unpack(header)
+    if ftype not in FRAME_TYPES:
+        raise ProtocolError(f"unknown frame type {ftype}")
+    if length > MAX_FRAME:
+        raise ProtocolError(f"frame of {length} bytes is over the {MAX_FRAME} byte limit")
+    if buf is not None and length <= len(buf):
+        payload = memoryview(buf)[:length]
+    else:
+        payload = memoryview(bytearray(length))
+    read_exact(rfile, payload)
+    ratelimit.charge(rfile, length)
+    metrics.inc("filesync_frames_total", direction="received")
+    metrics.inc("filesync_bytes_total", length, direction="received")
+    return ftype, rid, payload
+
+
+def recv_msg(rfile):
+    frame = recv_frame(rfile)
+    if frame is None:
+        return None, None
+    ftype, rid, payload = frame
+    if ftype != MSG:
+        raise ProtocolError(f"expected a message frame, got type {ftype}")
+    return rid, json.loads(bytes(payload).decode("utf-8"))
+
+
+# compression is negotiated once per session (the client offers CODECS, the
+# server keeps the first one it supports) and then applied per file by the
+# sender when choose_codec() thinks the file will shrink
+CODECS = ["zstd", "zlib"] if zstandard is not None else ["zlib"]
+INCOMPRESSIBLE = {
+    ".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".rar", ".apk", ".jar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".mp4", ".mkv", ".mov", ".avi", ".webm",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".odt",
+}
+SAMPLE_SIZE = 64 * 1024
+MIN_COMPRESS_SIZE = 512
+MIN_RATIO = 0.9  # the sample must shrink to at most this fraction
+
+compression_stats = {"files": 0, "skipped": 0, "raw_bytes": 0, "wire_bytes": 0}
+stats_lock = threading.Lock()
+
+
+def pick_codec(offered):
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return None
+
+
+def choose_codec(path, f, size, codec):
+    if codec is None or size < MIN_COMPRESS_SIZE:
+        return None
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE:
+        count_compression(0, 0, skipped=True)
+        return None
+    pos = f.tell()
+    sample = f.read(SAMPLE_SIZE)
+    f.seek(pos)
+    if len(zlib.compress(sample, 1)) > len(sample) * MIN_RATIO:
+        count_compression(0, 0, skipped=True)
+        return None
+    return codec
+
+
+def count_compression(raw, wire, skipped=False):
+    with stats_lock:
+        if skipped:
+            compression_stats["skipped"] += 1
+        else:
+            compression_stats["files"] += 1
+            compression_stats["raw_bytes"] += raw
+            compression_stats["wire_bytes"] += wire
+
+
+def compression_summary():
+    with stats_lock:
+        st = dict(compression_stats)
+    saved = st["raw_bytes"] - st["wire_bytes"]
+    return (f"compression: {st['files']} streams compressed, {st['skipped']} skipped, "
+            f"{st['raw_bytes']} -> {st['wire_bytes']} bytes ({saved} saved)")
+
+
+class Compressor:
+    def __init__(self, codec):
+        if codec == "zstd":
+            self.obj = zstandard.ZstdCompressor(level=3).compressobj()
+            self.block_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self.obj = zlib.compressobj(6)
+            self.block_mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush_block(self):
+        return self.obj.flush(self.block_mode)
+
+    def finish(self):
+        return self.obj.flush()
+
+
+def make_decompressor(codec):
+    if codec is None:
+        return None
+    if codec == "zstd":
+        if zstandard is None:
+            raise ProtocolError("peer sent zstd data but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
+
+
+def send_file(sock, f, size, rid, buf=None, codec=None, progress=None):
+    # streams at most `size` bytes as DATA frames and always terminates with END,
+    # so a file that shrank mid-transfer doesn't desync the connection.
+    # progress(n) is called with the file bytes of every chunk.
+    if buf is None:
+        buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    comp = Compressor(codec) if codec else None
+    sent = wire = 0
+    while sent < size:
+        n = f.readinto(view[:min(len(buf), size - sent)])
+        if not n:
+            break
+        sent += n
+        if progress is not None:
+            progress(n)
+        if comp is None:
+            send_frame(sock, DATA, rid, view[:n])
+            continue
+        out = comp.compress(view[:n])
+        if out:
+            send_frame(sock, DATA, rid, out)
+            wire += len(out)
+    if comp is not None:
+        out = comp.finish()
+        if out:
+            send_frame(sock, DATA, rid, out)
+            wire += len(out)
+        count_compression(sent, wire)
+    send_frame(sock, END, rid)
+    return sent
+
+
+def recv_file(rfile, f, rid, buf=None, codec=None, progress=None, sha=None):
+    # sha, if given, is updated with the file bytes as they are written
+    if buf is None:
+        buf = bytearray(CHUNK_SIZE)
+    decomp = make_decompressor(codec)
+    received = 0
+    while True:
+        frame = recv_frame(rfile, buf)
+        if frame is None:
+            raise ConnectionError("connection closed in the middle of a file")
+        ftype, frame_rid, payload = frame
+        if frame_rid != rid:
+            raise ProtocolError(f"frame for request {frame_rid} while receiving {rid}")
+        if ftype == END:
+            return received
+        if ftype != DATA:
+            raise ProtocolError(f"expected file data, got frame type {ftype}")
+        if decomp is not None:
+            payload = decomp.decompress(payload)
+        f.write(payload)
+        if sha is not None:
+            sha.update(payload)
+        received += len(payload)
+        if progress is not None:
+            progress(len(payload))
+
+
+# an interrupted transfer leaves <path>.part behind. the receiver offers its
+# length and a sha256 of those bytes, and if the sender's file starts the
+# same way only the rest is sent. smaller leftovers are simply restarted.
+RESUME_MIN_SIZE = 1024 * 1024
+
+
+def hash_prefix(f, n, buf=None):
+    if buf is None:
+        buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    sha = hashlib.sha256()
+    left = n
+    while left:
+        got = f.readinto(view[:min(len(buf), left)])
+        if not got:
+            return None
+        sha.update(view[:got])
+        left -= got
+    return sha.hexdigest()
+
+
+def part_offer(temp_path, buf=None):
+    # (offset, prefix hash) of a leftover .part worth resuming, else (0, None)
+    try:
+        with open(temp_path, "rb") as f:
+            n = os.fstat(f.fileno()).st_size
+            if n < RESUME_MIN_SIZE:
+                return 0, None
+            return n, hash_prefix(f, n, buf)
+    except OSError:
+        return 0, None
+
+
+def resume_offset(f, size, offset, prefix_hash, buf=None):
+    # sender side: leaves f positioned where sending should start and returns
+    # that offset, 0 if the receiver's prefix doesn't match this file
+    if offset and prefix_hash and offset <= size and hash_prefix(f, offset, buf) == prefix_hash:
+        return offset
+    f.seek(0)
+    return 0
+
+
+def open_part(temp_path, offset):
+    # receiver side: opens the .part for writing from `offset` onwards, or
+    # returns None if it no longer holds that many bytes
+    if not offset:
+        return open(temp_path, "wb")
+    try:
+        f = open(temp_path, "r+b")
+    except FileNotFoundError:
+        return None
+    if os.fstat(f.fileno()).st_size < offset:
+        f.close()
+        return None
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def recv_part(rfile, temp_path, offset, rid, buf=None, codec=None, progress=None, sha=None):
+    # returns the total length of the .part afterwards, or None if the resume
+    # point was gone (the stream is still consumed to keep the connection usable).
+    # sha only sees the bytes received now, so pass it only when offset is 0
+    f = open_part(temp_path, offset)
+    if f is None:
+        with open(os.devnull, "wb") as sink:
+            recv_file(rfile, sink, rid, buf, codec)
+        return None
+    with f:
+        return offset + recv_file(rfile, f, rid, buf, codec, progress, sha)
+
+
+# streamed file listings: entries go out as newline-delimited JSON rows in
+# DATA frames of LIST_BATCH rows each, optionally through one compressed
+# stream flushed at every batch. paths are front-coded against the previous row as
+# [shared_prefix_len, suffix, size, mtime(, hash)].
+LIST_BATCH = 1000
+
+
+def encode_list(entries, batch=LIST_BATCH):
+    prev = ""
+    rows = []
+    for e in entries:
+        path = e["path"]
+        n = len(os.path.commonprefix((prev, path)))
+        row = [n, path[n:], e["size"], e["mtime"]]
+        if "hash" in e:
+            row.append(e["hash"])
+        rows.append(json.dumps(row, separators=(",", ":")))
+        prev = path
+        if len(rows) >= batch:
+            yield ("\n".join(rows) + "\n").encode("utf-8")
+            rows = []
+    if rows:
+        yield ("\n".join(rows) + "\n").encode("utf-8")
+
+
+def send_list(sock, entries, rid, compress=None):
+    comp = Compressor(compress) if compress else None
+    raw = sent = 0
+    for batch in encode_list(entries):
+        raw += len(batch)
+        if comp is not None:
+            batch = comp.compress(batch) + comp.flush_block()
+        send_frame(sock, DATA, rid, batch)
+        sent += len(batch)
+    if comp is not None:
+        count_compression(raw, sent)
+    send_frame(sock, END, rid)
+    return raw, sent
+
+
+def recv_list(rfile, rid, compress=None):
+    # generator; it must be run to the end or the connection is left mid-stream
+    decomp = make_decompressor(compress)
+    prev = ""
+    while True:
+        frame = recv_frame(rfile)
+        if frame is None:
+            raise ConnectionError("connection closed in the middle of a listing")
+        ftype, frame_rid, payload = frame
+        if frame_rid != rid:
+            raise ProtocolError(f"frame for request {frame_rid} while receiving {rid}")
+        if ftype == END:
+            return
+        data = bytes(payload)
+        if decomp is not None:
+            data = decomp.decompress(data)
+        for line in data.splitlines():
+            row = json.loads(line)
+            path = prev[:row[0]] + row[1]
+            prev = path
+            entry = {"path": path, "size": row[2], "mtime": row[3]}
+            if len(row) > 4:
+                entry["hash"] = row[4]
+            yield entry
@@ -0,0 +1,92 @@
+import threading
+import time
+import weakref
+import metrics
+
+# bandwidth limits as token buckets, one per peer and direction: "up" is what
+# this process sends to the peer, "down" what it receives from it. a
+# connection's socket and reader are attached to their buckets when it opens
+# and protocol.send_frame/recv_frame charge every payload to them, so all
+# sessions to the same peer share one budget. rates are bytes per second from
+# the config's rate_limits section; 0 means unlimited, and configure() can
+# change them while transfers are running.
+
+# smallest burst, so a full frame never has to wait for more than one refill
+MIN_BURST = 256 * 1024
+
+
+class TokenBucket:
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = MIN_BURST
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = max(0, rate or 0)
+            self.burst = max(self.rate, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, n):
+        # takes n bytes, sleeping until the bucket has paid for them. tokens go
+        # negative instead of blocking under the lock, so concurrent senders
+        # queue up behind each other's debt. returns the seconds slept.
+        with self.lock:
+            now = time.monotonic()
+            if not self.rate:
+                self.stamp = now
+                return 0
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+lock = threading.Lock()
+limits = {}
+buckets = {}
+# socket or reader -> (bucket, peer, direction)
+attached = weakref.WeakKeyDictionary()
+
+
+def rate_for(peer, direction):
+    peer_limits = limits.get("peers", {}).get(peer, {})
+    return peer_limits.get(direction, limits.get(direction, 0))
+
+
+def bucket(peer, direction):
+    with lock:
+        b = buckets.get((peer, direction))
+        if b is None:
+            b = buckets[(peer, direction)] = TokenBucket(rate_for(peer, direction))
+        return b
+
+
+def configure(cfg):
+    global limits
+    with lock:
+        limits = cfg.get("rate_limits") or {}
+        for (peer, direction), b in buckets.items():
+            b.set_rate(rate_for(peer, direction))
+
+
+def attach(peer, sock, rfile=None):
+    attached[sock] = (bucket(peer, "up"), peer, "up")
+    if rfile is not None:
+        attached[rfile] = (bucket(peer, "down"), peer, "down")
+
+
+def charge(stream, n):
+    entry = attached.get(stream)
+    if entry is None or not n:
+        return
+    b, peer, direction = entry
+    waited = b.consume(n)
+    if waited:
+        metrics.inc("filesync_throttled_seconds_total", waited, peer=peer, direction=direction)
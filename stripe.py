@@ -0,0 +1,191 @@
+import json
+import os
+import threading
+from protocol import DATA, END, ProtocolError, recv_frame
+
+# striped transfer of one large file. the file is cut into byte ranges that
+# travel over parallel connections; the receiver preallocates
+# <path>.ranges.part, writes each range at its offset with os.pwrite and only
+# renames the file into place once the whole of it hashes to the sha-256 the
+# sender announced. a failed stripe fails the file, but the ranges written
+# so far are kept in <path>.ranges.log.part (see RangeLog), so the retry
+# only sends what is missing.
+
+# files below this go over a single stream
+STRIPE_MIN_SIZE = 64 * 1024 * 1024
+# frame payload and read size for range streams
+STRIPE_CHUNK = 1024 * 1024
+RANGE_SUFFIX = ".ranges.part"
+# ends in .part like every file a transfer leaves behind, so scans skip it
+RANGE_LOG_SUFFIX = ".ranges.log.part"
+# bytes received between saves of the range log
+RANGE_LOG_EVERY = 16 * 1024 * 1024
+# how long an extra stripe connection may take to be served. a server with
+# every worker busy leaves new connections waiting, so stripes that aren't
+# served by then are dropped and the file is cut into fewer ranges
+STRIPE_CONNECT_SEC = 5
+
+
+def split_missing(gaps, stripes):
+    # cuts the missing [start, end] ranges into at most `stripes` lists of
+    # (offset, length) with about the same number of bytes each, one list per
+    # connection
+    total = sum(end - start for start, end in gaps)
+    stripes = max(1, min(stripes, total // STRIPE_CHUNK or 1))
+    share = -(-total // stripes)
+    work = [[]]
+    room = share
+    for start, end in gaps:
+        while start < end:
+            if not room:
+                work.append([])
+                room = share
+            n = min(end - start, room)
+            work[-1].append((start, n))
+            start += n
+            room -= n
+    return [w for w in work if w]
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def preallocate(path, size, keep=False):
+    # with keep, bytes already in the file stay where they are
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | (0 if keep else os.O_TRUNC), 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            # no fallocate (macOS, some file systems): a sparse file of the right size
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def recv_range(rfile, fd, offset, rid, buf=None, progress=None, log=None):
+    # writes DATA frames at offset onwards until END; returns the byte count.
+    # with fd None the frames are only counted. every write is added to `log`
+    if buf is None:
+        buf = bytearray(STRIPE_CHUNK)
+    received = 0
+    while True:
+        frame = recv_frame(rfile, buf)
+        if frame is None:
+            raise ConnectionError("connection closed in the middle of a range")
+        ftype, frame_rid, payload = frame
+        if frame_rid != rid:
+            raise ProtocolError(f"frame for request {frame_rid} while receiving {rid}")
+        if ftype == END:
+            return received
+        if ftype != DATA:
+            raise ProtocolError(f"expected file data, got frame type {ftype}")
+        if fd is None:
+            received += len(payload)
+            continue
+        view = payload
+        while view:
+            n = os.pwrite(fd, view, offset + received)
+            received += n
+            view = view[n:]
+        if log is not None:
+            log.add(offset + received - len(payload), len(payload))
+        if progress is not None:
+            progress(len(payload))
+
+
+
+def merge(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class RangeLog:
+    # the [start, end] byte ranges of <path>.ranges.part already written,
+    # saved as json next to it every RANGE_LOG_EVERY bytes and whenever a
+    # stripe ends. the log names the size and sha-256 of the file being
+    # received, and only a later transfer of that same version picks it up.
+    def __init__(self, path, size, digest, done=()):
+        self.temp_path = path + RANGE_SUFFIX
+        self.log_path = path + RANGE_LOG_SUFFIX
+        self.size = size
+        self.digest = digest
+        self.done = merge(done)
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, size, digest, part_offset=0):
+        # the log an earlier attempt left for this version, or a new
+        # preallocated file. a new one starts from the first part_offset bytes
+        # of path + ".part", which the sender has confirmed; any other
+        # leftover .part is removed
+        part_path = path + ".part"
+        try:
+            with open(path + RANGE_LOG_SUFFIX) as f:
+                saved = json.load(f)
+            if saved["size"] == size and saved["hash"] == digest and os.path.getsize(path + RANGE_SUFFIX) == size:
+                remove_quietly(part_path)
+                return cls(path, size, digest, saved["done"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        log = cls(path, size, digest)
+        try:
+            if not 0 < part_offset <= min(size, os.path.getsize(part_path)):
+                raise OSError("no usable .part")
+            os.replace(part_path, log.temp_path)
+            os.truncate(log.temp_path, part_offset)
+            preallocate(log.temp_path, size, keep=True)
+            log.done = [[0, part_offset]]
+        except OSError:
+            remove_quietly(part_path)
+            preallocate(log.temp_path, size)
+        log.save()
+        return log
+
+    def add(self, offset, length):
+        with self.lock:
+            self.done = merge(self.done + [[offset, offset + length]])
+            self.unsaved += length
+            if self.unsaved >= RANGE_LOG_EVERY:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        temp = self.log_path + ".part"
+        with open(temp, "w") as f:
+            json.dump({"size": self.size, "hash": self.digest, "done": self.done}, f)
+        os.replace(temp, self.log_path)
+        self.unsaved = 0
+
+    def missing(self):
+        with self.lock:
+            gaps = []
+            pos = 0
+            for start, end in self.done:
+                if start > pos:
+                    gaps.append([pos, start])
+                pos = max(pos, end)
+            if pos < self.size:
+                gaps.append([pos, self.size])
+            return gaps
+
+    def finish(self):
+        # the file is in place; only the log is left to go
+        remove_quietly(self.log_path)
+
+    def discard(self):
+        remove_quietly(self.temp_path)
+        remove_quietly(self.log_path)
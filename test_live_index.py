@@ -0,0 +1,37 @@
+import os
+import time
+from live_index import LiveIndex
+
+
+def make_tree(root):
+    for name in ("a/one.txt", "a/two.txt", "a/deep/three.txt", "b/four.txt"):
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(name)
+
+
+def test_update_dirs_journals_nothing_for_unchanged_files(tmp_path):
+    make_tree(tmp_path)
+    live = LiveIndex(str(tmp_path))
+    cursor = live.rescan()
+    live.update_dirs(["a"])
+    assert live.generation == cursor
+    assert live.changes_since(cursor) == []
+
+
+def test_update_dirs_journals_only_what_changed(tmp_path):
+    make_tree(tmp_path)
+    live = LiveIndex(str(tmp_path))
+    cursor = live.rescan()
+    os.remove(tmp_path / "a" / "two.txt")
+    (tmp_path / "a" / "deep" / "five.txt").write_text("new")
+    later = time.time() + 10
+    os.utime(tmp_path / "a" / "one.txt", (later, later))
+    live.update_dirs(["a"])
+    changes = {(c["op"], c["path"]) for c in live.changes_since(cursor)}
+    assert changes == {
+        ("delete", os.path.join("a", "two.txt")),
+        ("add", os.path.join("a", "deep", "five.txt")),
+        ("modify", os.path.join("a", "one.txt")),
+    }
@@ -1,10 +1,25 @@
 # for client device
 import socket 
 import ssl
-import json
 import os
+import hashlib
+import threading
+from collections import deque
+import metrics
+import ratelimit
 from config import get_config
-from sync_core import scan_dir
+from sync_core import scan_dir, scan_paths, SCAN_WORKERS
+from merkle import reconcile
+from protocol import CHUNK_SIZE, CODECS, RESUME_MIN_SIZE, DATA, END, recv_msg, send_msg, send_frame, send_file, recv_list, choose_codec, part_offer, resume_offset, recv_part
+from batch import BATCH_MAX_FILE, BatchPacker, BatchUnpacker, batch_codec, pack_files
+from delta import block_size_for, signature, send_delta, recv_delta
+from stripe import STRIPE_CHUNK, STRIPE_CONNECT_SEC, RANGE_LOG_SUFFIX, RangeLog, split_missing, recv_range
+from hasher import hash_file
+
+# how long connecting, the TLS handshake and the session hello may take. a
+# server with every worker busy leaves new connections waiting, which without
+# a bound would hang the client for good
+CONNECT_TIMEOUT_SEC = 30
 
 # CERT_DIR = os.path.expanduser('~/sync-certs')
 # CLIENT_CERT = os.path.join(CERT_DIR, 'android.crt')
@@ -41,17 +56,6 @@ from sync_core import scan_dir
 # client_socket.close()
 # print("connection closed")
 
-def recv_all(client_socket, chunk=8192):
-    chunks = []
-    while True:
-        data = client_socket.recv(chunk)
-        if not data:
-            break
-        chunks.append(data)
-    
-
-    return b"".join(chunks)
-
 def make_client_context(CLIENT_CERT,CLIENT_KEY,SERVER_CERT):
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
     context.load_cert_chain(CLIENT_CERT, CLIENT_KEY)
@@ -60,15 +64,25 @@ def make_client_context(CLIENT_CERT,CLIENT_KEY,SERVER_CERT):
     context.verify_mode = ssl.CERT_REQUIRED
     return context
 
+def connect_tls(host, port, context, timeout=CONNECT_TIMEOUT_SEC):
+    # a one-request connection; only the connect and handshake are bounded
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    tls = context.wrap_socket(s, server_hostname=host)
+    try:
+        tls.connect((host, port))
+    except OSError:
+        tls.close()
+        raise
+    tls.settimeout(None)
+    return tls
+
 def request_list(host,port,context):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    with context.wrap_socket(client_socket,server_hostname=host) as tls:
-        tls.connect((host,port))
-        message = {"type":"list"}
-        tls.send(json.dumps(message).encode('utf-8'))
-        raw = recv_all(tls)
-    resp = json.loads(raw.decode('utf-8'))
-    assert resp.get('type') == "list_response", f"unexpected response type: {resp}" 
+    with connect_tls(host,port,context) as tls:
+        send_msg(tls, {"type":"list"}, 1)
+        with tls.makefile("rb") as rfile:
+            rid, resp = recv_msg(rfile)
+    assert resp is not None and resp.get('type') == "list_response", f"unexpected response type: {resp}" 
     return resp["files"]
 
 def get_cert():
@@ -88,115 +102,666 @@ def get_cert():
     return CLIENT_CERT,CLIENT_KEY,SERVER_CERT
 def to_map(entries):
     return {e["path"]:e for e in entries}
-def compute_actions(local_files,remote_files,skew_sec=2.0):
-    action = {"push":[],"pull":[],"skip":[]}
+# files up to this size aren't matched as moves: a rename or copy request
+# costs about as much as sending them in a batch, and every empty file would
+# otherwise match every other one
+MOVE_MIN_SIZE = BATCH_MAX_FILE
+
+def content_key(e):
+    if isinstance(e, dict) and e.get("hash") and e["size"] > MOVE_MIN_SIZE:
+        return (e["size"], e["hash"])
+    return None
+
+def compute_actions(local_files,remote_files,skew_sec=2.0,gone=()):
+    # remote_files may be a generator (a streamed listing); it is consumed
+    # once, entry by entry, against a map of the local side. `gone` lists
+    # paths deleted or moved locally since the last scan. a push of a path the
+    # server already has is marked "remote", so only those try a delta.
+    action = {"push":[],"pull":[],"skip":[],"rename":[],"copy":[],"copy_local":[]}
     L = to_map(local_files)
-    R = to_map(remote_files)
-    all_paths = set(L) | set(R)
-    for p in all_paths:
-        le = L.get(p)
-        re = R.get(p)
-        if le and not re:
-            action["push"].append(le)
-        elif re and not le:
+    local_content = {content_key(e): e["path"] for e in L.values() if content_key(e)}
+    remote_content = {}
+    for re in remote_files:
+        p = re["path"]
+        if content_key(re):
+            remote_content.setdefault(content_key(re), p)
+        le = L.pop(p, None)
+        if not le:
             action["pull"].append(re)
+        elif le.get("hash") and re.get("hash"):
+            # content hashes make mtime only a tie-breaker for direction
+            dt = (le["mtime"]-re["mtime"])
+            if le["hash"] == re["hash"]:
+                action["skip"].append(p)
+            elif dt >= 0:
+                action["push"].append(dict(le, remote=True))
+            else:
+                action["pull"].append(re)
         else:
             dt = (le["mtime"]-re["mtime"])
             if abs(dt) <=skew_sec:
                 action["skip"].append(p)
             elif dt > 0:
-                action["push"].append(p)
+                action["push"].append(dict(le, remote=True))
             else:
-                action["pull"].append(p)
+                action["pull"].append(re)
+    action["push"].extend(L.values())
+    match_moves(action, local_content, remote_content, gone)
     return action
 
+def match_moves(action, local_content, remote_content, gone):
+    # content one side already has under another path isn't transferred
+    # again: a new local file matching a remote one is renamed on the server
+    # when its old path is gone here, copied there otherwise, and a pull
+    # matching a local file is copied locally
+    gone = set(gone)
+    moved_away = set()
+    push = []
+    for le in action["push"]:
+        src = remote_content.get(content_key(le))
+        if src is None or src == le["path"]:
+            push.append(le)
+        elif src in gone and src not in moved_away:
+            moved_away.add(src)
+            action["rename"].append(dict(le, source=src))
+        else:
+            action["copy"].append(dict(le, source=src))
+    action["push"] = push
+    pull = []
+    for re in action["pull"]:
+        if action_path(re) in moved_away:
+            continue
+        src = local_content.get(content_key(re))
+        if src is None or src == re["path"]:
+            pull.append(re)
+        else:
+            action["copy_local"].append(dict(re, source=src))
+    action["pull"] = pull
+
 def push(host,port,context, local_file, remote_path):
     size = os.path.getsize(local_file)
     mtime = os.path.getmtime(local_file)
-    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM) 
-    with context.wrap_socket(s,server_hostname=host) as tls:
-        tls.connect((host,port))
+    with connect_tls(host,port,context) as tls:
+        ratelimit.attach(host, tls)
 
         msg = {"type":"push","path":remote_path,"size":size,"mtime":mtime}
-        tls.send(json.dumps(msg).encode('utf-8'))
+        send_msg(tls, msg, 1)
         with open(local_file,'rb') as f:
-            sent = 0
-            while sent < size:
-                chunk = f.read(8192)
-                if not chunk:
-                    break
-                tls.send(chunk)
-                sent += len(chunk)
+            send_file(tls, f, size, 1)
 
-        ack = recv_all(tls)
-        resp = json.loads(ack.decode('utf-8'))
+        with tls.makefile("rb") as rfile:
+            rid, resp = recv_msg(rfile)
         print(f"Push response: {resp}")
         return resp
 
+def landed(meta, local_file, digest):
+    # tags a pull reply with the new file's stat and the digest taken while it
+    # was written, so the hash index can take it without reading the file
+    return dict(meta, landed=(os.stat(local_file), digest))
+
+def receive_into(rfile, rid, meta, local_file, buf=None, progress=None):
+    size = meta.get("size")
+    remote_mtime = meta.get("mtime")
+    temp_file = local_file + ".part"
+    os.makedirs(os.path.dirname(local_file),exist_ok=True)
+    offset = meta.get("offset", 0)
+    if offset:
+        print(f"Resuming {meta.get('path')} at {offset} bytes")
+    sha = None if offset else hashlib.sha256()
+    recived = recv_part(rfile, temp_file, offset, rid, buf, meta.get("codec"), progress, sha)
+    if recived is None:
+        print(f"ERROR: partial file {temp_file} is gone, can't resume")
+        return {"type":"error","message":"resume_mismatch"}
+    if recived != size:
+        print(f"ERROR: size mismatch. Expected {size}, got {recived}")
+        return {"type":"error","message":"size_mismatch"}
+    os.replace(temp_file,local_file)
+    if remote_mtime is not None:
+        try:
+            os.utime(local_file, (remote_mtime, remote_mtime))
+        except Exception as e:
+            print(f"WARNING: could not set mtime for {local_file}: {e}")
+    if sha is not None:
+        return landed(meta, local_file, sha.hexdigest())
+    return meta
+
 def pull(host,port,context,remote_path, local_file):
-    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM) 
-    with context.wrap_socket(s,server_hostname=host) as tls:
-        tls.connect((host,port))
+    with connect_tls(host,port,context) as tls:
 
-        msg = {"type":"pull","path":remote_path}
-        tls.send(json.dumps(msg).encode("utf-8"))
+        send_msg(tls, pull_request(remote_path, local_file), 1)
         print(f"pulling {remote_path} to {local_file}")
 
-        meta_raw = tls.recv(8192)
-        meta = json.loads(meta_raw.decode("utf-8"))
-        if meta.get("type") == "error":
-            print(f"Error from server: {meta.get('message')}")
-            return meta
-        size = meta.get("size")
-        remote_mtime = meta.get("mtime")
+        with tls.makefile("rb") as rfile:
+            ratelimit.attach(host, tls, rfile)
+            rid, meta = recv_msg(rfile)
+            if meta.get("type") == "error":
+                print(f"Error from server: {meta.get('message')}")
+                return meta
+            resp = receive_into(rfile, rid, meta, local_file)
+        if resp.get("type") == "error":
+            return resp
+        print(f"File '{remote_path}' pulled successfully.")
+        return local_file
+
+def pull_request(remote_path, local_file, buf=None):
+    msg = {"type":"pull","path":remote_path}
+    offset, prefix_hash = part_offer(local_file + ".part", buf)
+    if offset:
+        msg["offset"] = offset
+        msg["prefix_hash"] = prefix_hash
+    return msg
+
+class SessionUnsupported(Exception):
+    pass
+
+
+class SyncSession:
+    # one TLS connection for many list/push/pull requests. frames carry the
+    # request id and up to `window` of them may be in flight before we wait for replies.
+    def __init__(self, host, port, context, window=32):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.window = window
+        self.tls = None
+        self.rfile = None
+        self.buf = None
+        self.codec = None
+        self.features = []
+        # progress(kind, path, nbytes) hears about file bytes as they stream
+        self.progress = None
+        # landed(path) is told about each pulled file as soon as it is in
+        # place, which for pipelined pulls is well before their reply is returned
+        self.landed = None
+        self.next_id = 0
+        self.pending = deque()
+
+    def connect(self, timeout=CONNECT_TIMEOUT_SEC):
+        # timeout bounds the connect, handshake and hello; the session itself
+        # then blocks as usual
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        self.tls = self.context.wrap_socket(s, server_hostname=self.host)
+        try:
+            with metrics.timed("filesync_tls_handshake_seconds", side="client"):
+                self.tls.connect((self.host, self.port))
+            self.rfile = self.tls.makefile("rb")
+            ratelimit.attach(self.host, self.tls, self.rfile)
+            self.buf = bytearray(CHUNK_SIZE)
+            send_msg(self.tls, {"type": "session", "compress": CODECS})
+            rid, hello = self._read_msg()
+        except OSError:
+            if self.rfile is not None:
+                self.rfile.close()
+            self.tls.close()
+            self.tls = None
+            raise
+        if hello.get("type") != "session_ok":
+            self.close()
+            raise SessionUnsupported(f"server answered {hello}")
+        self.tls.settimeout(None)
+        self.codec = hello.get("compress")
+        self.features = hello.get("features", [])
+        return self
+
+    def close(self):
+        if self.tls is None:
+            return
+        try:
+            send_msg(self.tls, {"type": "bye"})
+        except OSError:
+            pass
+        self.rfile.close()
+        self.tls.close()
+        self.tls = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _progress(self, kind, path):
+        if self.progress is None:
+            return None
+        return lambda n: self.progress(kind, path, n)
+
+    def _send_msg(self, msg):
+        self.next_id += 1
+        send_msg(self.tls, msg, self.next_id)
+        return self.next_id
+
+    def _read_msg(self):
+        rid, msg = recv_msg(self.rfile)
+        if msg is None:
+            raise ConnectionError("session closed by server")
+        return rid, msg
+
+    def part_info(self, remote_path):
+        # (offset, prefix hash) of the server's leftover .part for this path
+        rid = self._send_msg({"type": "part_info", "path": remote_path})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "part_info_response":
+            return 0, None
+        return resp["offset"], resp["hash"]
+
+    def _drain_pulls(self):
+        # the server streams pull data as soon as it gets to a pull; unless
+        # that is read before we stream push data, both sides block writing
+        last = max((i for i, p in enumerate(self.pending) if p[1] == "pull"), default=None)
+        if last is None:
+            return []
+        return self.drain(len(self.pending) - last - 1)
+
+    def submit_push(self, local_file, remote_path):
+        size = os.path.getsize(local_file)
+        mtime = os.path.getmtime(local_file)
+        replies = self._drain_pulls()
+        offer = (0, None)
+        if size >= RESUME_MIN_SIZE and "resume" in self.features:
+            # resuming needs the server's answer before sending, so this
+            # costs a round trip and empties the pipeline
+            replies += self.drain(0)
+            offer = self.part_info(remote_path)
+        with open(local_file, 'rb') as f:
+            offset = resume_offset(f, size, *offer, self.buf)
+            if offset:
+                print(f"Resuming push of {remote_path} at {offset} bytes")
+            codec = choose_codec(remote_path, f, size - offset, self.codec)
+            rid = self._send_msg({"type": "push", "path": remote_path, "size": size, "mtime": mtime, "codec": codec, "offset": offset})
+            send_file(self.tls, f, size - offset, rid, self.buf, codec, self._progress("push", remote_path))
+        self.pending.append((rid, "push", remote_path, local_file))
+        return replies + self.drain(self.window)
+
+    def open_push(self, remote_path, size, mtime, codec):
+        # a push whose data the caller streams with push_chunk and ends with
+        # close_push, for sending one read of a file to several peers.
+        # returns (rid, replies that had to be read first)
+        replies = self._drain_pulls()
+        rid = self._send_msg({"type": "push", "path": remote_path, "size": size, "mtime": mtime, "codec": codec, "offset": 0})
+        return rid, replies
+
+    def push_chunk(self, rid, data):
+        send_frame(self.tls, DATA, rid, data)
+
+    def close_push(self, rid, remote_path, local_file):
+        send_frame(self.tls, END, rid)
+        self.pending.append((rid, "push", remote_path, local_file))
+        return self.drain(self.window)
+
+    def submit_pull(self, remote_path, local_file):
+        rid = self._send_msg(pull_request(remote_path, local_file, self.buf))
+        self.pending.append((rid, "pull", remote_path, local_file))
+        return self.drain(self.window)
+
+    def drain(self, limit=0):
+        results = []
+        while len(self.pending) > limit:
+            rid, kind, path, local_file = self.pending.popleft()
+            resp_id, resp = self._read_msg()
+            if resp_id != rid:
+                raise ConnectionError(f"expected reply to request {rid}, got {resp_id}: {resp}")
+            if kind == "pull" and resp.get("type") == "pull_response":
+                resp = receive_into(self.rfile, rid, resp, local_file, self.buf, self._progress("pull", path))
+                if self.landed is not None and resp.get("type") != "error":
+                    self.landed(path)
+            results.append((kind, path, resp))
+        return results
+
+    def list(self):
+        self.drain(0)
+        rid = self._send_msg({"type": "list"})
+        resp_id, resp = self._read_msg()
+        assert resp_id == rid and resp.get("type") == "list_response", f"unexpected response type: {resp}"
+        return resp["files"]
+
+    def iter_list(self, compress=True):
+        # yields remote entries as batches arrive; falls back to the one-shot
+        # list for servers without streamed listings
+        self.drain(0)
+        rid = self._send_msg({"type": "list_stream", "compress": self.codec if compress else None})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "list_stream_response":
+            yield from self.list()
+            return
+        yield from recv_list(self.rfile, rid, resp.get("compress"))
+
+    def stat(self, paths):
+        # remote entries for just these paths, or None if the server can't answer
+        self.drain(0)
+        rid = self._send_msg({"type": "stat", "paths": list(paths), "stream": True})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "stat_response":
+            return None
+        if resp.get("stream"):
+            return list(recv_list(self.rfile, rid, resp.get("compress")))
+        return resp["files"]
+
+    def tree_diff(self, dirs, fresh=False):
+        # (the answer for each directory, the remote file entries they name),
+        # or None if the server can't answer tree requests. entries come as a
+        # listing stream from servers that offer one, else inline per directory
+        self.drain(0)
+        rid = self._send_msg({"type": "tree_diff", "dirs": dirs, "fresh": fresh, "stream": True})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "tree_diff_response":
+            return None
+        if resp.get("stream"):
+            return resp["dirs"], list(recv_list(self.rfile, rid, resp.get("compress")))
+        return resp["dirs"], [e for reply in resp["dirs"].values() for e in reply.get("files", [])]
+
+    def metrics(self):
+        # the server's metrics registry as a dict, None if it doesn't export one
+        self.drain(0)
+        rid = self._send_msg({"type": "metrics"})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "metrics_response":
+            return None
+        return resp["metrics"]
+
+    def changes_since(self, cursor, epoch, wait=0):
+        # the server's change journal after `cursor`; with `wait` the server
+        # holds the reply until something changes. None if it keeps no journal.
+        # a server with too many polls waiting answers at once with
+        # "retry_after", the seconds to wait before polling again
+        self.drain(0)
+        rid = self._send_msg({"type": "changes_since", "cursor": cursor, "epoch": epoch, "wait": wait})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "changes":
+            return None
+        return resp
+
+    def move(self, entry, copy=False):
+        # server-side rename (or copy) of entry["source"] to entry["path"];
+        # None if the server can't, so the caller sends the data instead
+        if "move" not in self.features:
+            return None
+        self.drain(0)
+        rid = self._send_msg({"type": "move", "source": entry["source"], "path": entry["path"],
+                              "hash": entry["hash"], "mtime": entry["mtime"], "copy": copy})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") == "error":
+            print(f"Server-side {'copy' if copy else 'rename'} of {entry['path']} failed: {resp.get('message')}")
+            return None
+        return resp
+
+    def push_delta(self, local_file, remote_path):
+        # returns None when the server has no copy to diff against (or doesn't
+        # speak delta), so the caller can fall back to a full push
+        self.drain(0)
+        rid = self._send_msg({"type": "signature", "path": remote_path})
+        resp_id, sig = self._read_msg()
+        if sig.get("type") != "signature_response":
+            return None
+        size = os.path.getsize(local_file)
+        mtime = os.path.getmtime(local_file)
+        block_size = sig["block_size"]
+        rid = self._send_msg({"type": "push_delta", "path": remote_path, "size": size, "mtime": mtime, "block_size": block_size})
+        with open(local_file, "rb") as f:
+            literal, copied = send_delta(self.tls, f, sig["blocks"], block_size, rid)
+        resp_id, resp = self._read_msg()
+        print(f"Delta push {remote_path}: {literal} literal bytes, {copied} reused")
+        if resp.get("type") == "error":
+            return None
+        resp["literal"] = literal
+        return resp
+
+    def pull_delta(self, remote_path, local_file):
+        self.drain(0)
+        block_size = block_size_for(os.path.getsize(local_file))
+        with open(local_file, "rb") as f:
+            blocks = signature(f, block_size)
+        rid = self._send_msg({"type": "pull_delta", "path": remote_path, "block_size": block_size, "blocks": blocks})
+        resp_id, meta = self._read_msg()
+        if meta.get("type") != "pull_delta_response":
+            return None
         temp_file = local_file + ".part"
-        os.makedirs(os.path.dirname(local_file),exist_ok=True)
-        with open(temp_file,"wb") as f:
-            recived = 0
-            while recived < size:
-                chunk = tls.recv(8192)
-                if not chunk:
-                    break
-                f.write(chunk)
-                recived += len(chunk)
-        if recived != size:
-            print(f"ERROR: size mismatch. Expected {size}, got {recived}")
-            return {"type":"error","message":"size_mismatch"}
-        os.replace(temp_file,local_file)
-        if remote_mtime is not None:
+        with open(local_file, "rb") as basis, open(temp_file, "wb") as out:
+            got, digest, expected = recv_delta(self.rfile, rid, basis, out, block_size, self.buf)
+        if got != meta["size"] or digest != expected:
+            print(f"ERROR: delta for {remote_path} did not rebuild the file")
+            os.remove(temp_file)
+            return None
+        os.replace(temp_file, local_file)
+        if meta.get("mtime") is not None:
             try:
-                os.utime(local_file, (remote_mtime, remote_mtime))
+                os.utime(local_file, (meta["mtime"], meta["mtime"]))
             except Exception as e:
                 print(f"WARNING: could not set mtime for {local_file}: {e}")
-       
-        print(f"File '{remote_path}' pulled successfully.")
-        return local_file
-def sync(host,port,context,local_dir,actions):
-    push_count,pull_count = 0, 0
-    for a in actions["push"]:
-        if isinstance(a,dict):
-            path = a["path"]
-        else:
-            path = a
+        print(f"Delta pull {remote_path}: {got} bytes rebuilt")
+        return landed(meta, local_file, digest)
+
+    def push_batch(self, local_dir, paths, max_file=BATCH_MAX_FILE):
+        # returns {path: None or error} for every path; files over max_file
+        # come back as TOO_LARGE_ERROR
+        self.drain(0)
+        codec = batch_codec(local_dir, paths, self.codec)
+        rid = self._send_msg({"type": "push_batch", "codec": codec})
+        errors = pack_files(BatchPacker(self.tls, rid, codec), local_dir, paths, max_file)
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "batch_ack":
+            raise ConnectionError(f"unexpected reply to batch push: {resp}")
+        errors.update(resp.get("errors", {}))
+        return {p: errors.get(p) for p in paths}
+
+    def pull_batch(self, local_dir, paths, index=None, max_file=BATCH_MAX_FILE):
+        self.drain(0)
+        rid = self._send_msg({"type": "pull_batch", "paths": list(paths), "max_file": max_file})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "pull_batch_response":
+            raise ConnectionError(f"unexpected reply to batch pull: {resp}")
+        results = BatchUnpacker(local_dir, index, self.landed, max_file).read_stream(self.rfile, rid, resp.get("codec"), self.buf)
+        return {p: results.get(p, "missing from batch") for p in paths}
+
+    def _stripes(self, gaps, stripes, run):
+        # run(session, offset, length) for every missing byte range, the
+        # ranges cut into one list per connection and the lists run at once:
+        # the first on this session, the others on sessions opened for the
+        # purpose. only as many connections are used as could be opened
+        # within STRIPE_CONNECT_SEC, down to one; returns how many that was
+        errors = []
+
+        def stripe(session, ranges):
+            try:
+                for offset, length in ranges:
+                    run(session, offset, length)
+            except Exception as e:
+                errors.append(e)
+
+        siblings = []
+        try:
+            for _ in split_missing(gaps, stripes)[1:]:
+                try:
+                    sibling = SyncSession(self.host, self.port, self.context).connect(STRIPE_CONNECT_SEC)
+                except (OSError, SessionUnsupported) as e:
+                    print(f"only {len(siblings) + 1} of {stripes} stripes could connect ({e})")
+                    break
+                sibling.progress = self.progress
+                siblings.append(sibling)
+            work = split_missing(gaps, len(siblings) + 1)
+            threads = [threading.Thread(target=stripe, args=(sibling, ranges), daemon=True)
+                       for sibling, ranges in zip(siblings, work[1:])]
+            for t in threads:
+                t.start()
+            if work:
+                stripe(self, work[0])
+            for t in threads:
+                t.join()
+        finally:
+            for sibling in siblings:
+                sibling.close()
+        if errors:
+            raise errors[0]
+        return len(work)
+
+    def push_striped(self, local_file, remote_path, stripes, digest=None):
+        # sends a large file as byte ranges over parallel connections; the
+        # server only keeps it if the whole file hashes to `digest`. ranges it
+        # kept from an earlier attempt, or the confirmed prefix of its .part,
+        # aren't sent again
+        self.drain(0)
+        st = os.stat(local_file)
+        if digest is None:
+            digest = hash_file(local_file)
+        part_offset = 0
+        if "resume" in self.features:
+            offset, prefix_hash = self.part_info(remote_path)
+            if offset:
+                with open(local_file, "rb") as f:
+                    part_offset = resume_offset(f, st.st_size, offset, prefix_hash, self.buf)
+        rid = self._send_msg({"type": "push_begin", "path": remote_path, "size": st.st_size, "hash": digest, "part_offset": part_offset})
+        resp_id, resp = self._read_msg()
+        if resp.get("type") != "push_begin_ok":
+            return resp
+        gaps = resp.get("missing", [[0, st.st_size]])
+        left = sum(end - start for start, end in gaps)
+        if left < st.st_size:
+            print(f"Resuming striped push of {remote_path}: {left} of {st.st_size} bytes left")
+
+        def run(session, offset, length):
+            with open(local_file, "rb") as f:
+                f.seek(offset)
+                rid = session._send_msg({"type": "push_range", "path": remote_path, "offset": offset, "length": length})
+                send_file(session.tls, f, length, rid, bytearray(STRIPE_CHUNK), None, session._progress("push", remote_path))
+            resp_id, resp = session._read_msg()
+            if resp.get("type") != "push_range_ok":
+                raise ConnectionError(f"range {offset}+{length} of {remote_path} failed: {resp.get('message')}")
+
+        used = self._stripes(gaps, stripes, run)
+        rid = self._send_msg({"type": "push_commit", "path": remote_path, "size": st.st_size, "mtime": st.st_mtime, "hash": digest})
+        resp_id, resp = self._read_msg()
+        print(f"Striped push {remote_path}: {left} bytes over {used} connections")
+        return resp
+
+    def pull_striped(self, remote_path, local_file, stripes):
+        # a failed pull keeps <local_file>.ranges.part and its RangeLog for
+        # the next attempt; a leftover .part the server confirms seeds it
+        self.drain(0)
+        msg = {"type": "range_info", "path": remote_path}
+        if not os.path.exists(local_file + RANGE_LOG_SUFFIX):
+            offset, prefix_hash = part_offer(local_file + ".part", self.buf)
+            if offset:
+                msg["offset"], msg["prefix_hash"] = offset, prefix_hash
+        rid = self._send_msg(msg)
+        resp_id, info = self._read_msg()
+        if info.get("type") != "range_info_response":
+            return info
+        size = info["size"]
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        log = RangeLog.open(local_file, size, info["hash"], info.get("part_offset", 0))
+        gaps = log.missing()
+        left = sum(end - start for start, end in gaps)
+        if left < size:
+            print(f"Resuming striped pull of {remote_path}: {left} of {size} bytes left")
+        fd = os.open(log.temp_path, os.O_WRONLY)
+
+        def run(session, offset, length):
+            rid = session._send_msg({"type": "pull_range", "path": remote_path, "offset": offset, "length": length,
+                                     "size": size, "mtime": info["mtime"]})
+            resp_id, resp = session._read_msg()
+            if resp.get("type") != "pull_range_response":
+                raise ConnectionError(f"range {offset}+{length} of {remote_path} failed: {resp.get('message')}")
+            got = recv_range(session.rfile, fd, offset, rid, bytearray(STRIPE_CHUNK), session._progress("pull", remote_path), log)
+            if got != length:
+                raise ConnectionError(f"range {offset}+{length} of {remote_path} ended after {got} bytes")
+
+        try:
+            used = self._stripes(gaps, stripes, run)
+        finally:
+            os.close(fd)
+            log.save()
+        digest = hash_file(log.temp_path)
+        if digest != info["hash"]:
+            print(f"ERROR: striped pull of {remote_path} does not match its hash")
+            log.discard()
+            return {"type": "error", "message": "hash_mismatch"}
+        os.replace(log.temp_path, local_file)
+        log.finish()
+        try:
+            os.utime(local_file, (info["mtime"], info["mtime"]))
+        except Exception as e:
+            print(f"WARNING: could not set mtime for {local_file}: {e}")
+        print(f"Striped pull {remote_path}: {left} bytes over {used} connections")
+        return landed(info, local_file, digest)
+
+    def push(self, local_file, remote_path):
+        self.submit_push(local_file, remote_path)
+        return self.drain(0)[-1][2]
+
+    def pull(self, remote_path, local_file):
+        self.submit_pull(remote_path, local_file)
+        return self.drain(0)[-1][2]
+
+
+def open_session(host, port, context, timeout=CONNECT_TIMEOUT_SEC):
+    try:
+        return SyncSession(host, port, context).connect(timeout)
+    except SessionUnsupported as e:
+        print(f"Session mode unavailable, using one connection per file: {e}")
+        return None
+
+
+def plan_actions(session, host, port, context, local_dir, index=None, paths=None, skew_sec=2.0, workers=SCAN_WORKERS):
+    # paths=None compares whole trees via the hash tree (or a full listing for
+    # servers without it); otherwise only the given relative paths are compared
+    with metrics.timed(phase="plan"):
+        return _plan_actions(session, host, port, context, local_dir, index, paths, skew_sec, workers)
 
-        local_file = os.path.join(local_dir,path)
-        if os.path.exists(local_file):
-            print(f"Push:{path}")
-            push(host,port,context,local_file,path)
-            push_count += 1
-        else:
-            print(f"Push: {path} not found")
 
-    for a in actions["pull"]:
-        if isinstance(a,dict):
-            path = a["path"]
+def _plan_actions(session, host, port, context, local_dir, index, paths, skew_sec, workers):
+    l_files, gone = scan_local(local_dir, index, paths, workers)
+    return plan_remote(session, host, port, context, l_files, gone, paths, skew_sec)
+
+
+def scan_local(local_dir, index=None, paths=None, workers=SCAN_WORKERS):
+    # (local entries, paths deleted or moved since the last scan); the same
+    # scan can be planned against any number of peers
+    gone = []
+    if paths is None:
+        l_files = scan_dir(local_dir, index=index, workers=workers)
+        if index is not None:
+            gone = index.removed
+    else:
+        l_files = scan_paths(local_dir, paths, index=index)
+        if index is not None:
+            found = set(e["path"] for e in l_files)
+            gone = index.drop([p for p in paths if p not in found])
+    return l_files, gone
+
+
+def plan_remote(session, host, port, context, l_files, gone=(), paths=None, skew_sec=2.0, remote_paths=None):
+    # compares a local scan with one peer. remote_paths, if given, collects
+    # the peer's paths that took part in the comparison
+    if paths is None:
+        diff = reconcile(session, l_files) if session is not None else None
+        if diff is not None:
+            l_files, r_files = diff
+        elif session is not None:
+            r_files = session.iter_list()
         else:
-            path = a
-        local_file = os.path.join(local_dir,path)
-        print(f"Pull:{path}")
-        pull(host,port,context,path,local_file)
-        pull_count += 1
-    print(f"Sync complete. Pushed {push_count} files, Pulled {pull_count} files.")
+            r_files = request_list(host, port, context)
+    else:
+        r_files = session.stat(paths) if session is not None else None
+        if r_files is None:
+            wanted = set(paths)
+            r_files = [e for e in request_list(host, port, context) if e["path"] in wanted]
+    if remote_paths is not None:
+        r_files = tap_paths(r_files, remote_paths)
+    return compute_actions(l_files, r_files, skew_sec=skew_sec, gone=gone)
+
+
+def tap_paths(entries, seen):
+    for e in entries:
+        seen.add(e["path"])
+        yield e
+
+
+def action_path(a):
+    if isinstance(a, dict):
+        return a["path"]
+    return a
+
+
 # if __name__ == "__main__":
 #     config = get_config()
 #     host = config["peer"]["host"]
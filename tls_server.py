@@ -1,144 +1,879 @@
 import socket
 import ssl
 import threading
-import json
+import queue
+import signal
+import time
 import os
-from config import get_config
-from sync_core import scan_dir
+import shutil
+import hashlib
+import itertools
+import metrics
+import ratelimit
+from config import get_config, CONFIG, reload_on_signal
+from sync_core import scan_paths, iter_entries, compute_hash, SCAN_WORKERS
+from hash_index import open_index
+from live_index import LiveIndex
+from merkle import build_tree, describe
+from batch import BATCH_MAX_FILE, BatchPacker, BatchUnpacker, batch_codec, pack_files
+from delta import block_size_for, signature, send_delta, recv_delta
+from stripe import STRIPE_CHUNK, RangeLog, recv_range
+from hasher import hash_file
+from protocol import CHUNK_SIZE, recv_msg, send_msg, send_file, send_list, pick_codec, choose_codec, compression_summary, part_offer, resume_offset, recv_part
 
-CERT_DIR = os.path.expanduser('~/sync-certs')
-SERVER_CERT = os.path.join(CERT_DIR, 'linux.crt')
-SERVER_KEY = os.path.join(CERT_DIR, 'linux.key')
-PEER_CERT = os.path.join(CERT_DIR, 'android.crt')
+# session requests a client can't probe safely because a data stream follows
+# the header; older servers simply don't list them
+FEATURES = ["batch", "resume", "move", "ranges"]
+# longest a changes_since long poll may wait
+CHANGES_WAIT_MAX = 60
+# sessions that may wait in a long poll at once, config key
+# server.max_long_polls; past that a poll is answered at once and the client
+# told to come back after CHANGES_RETRY_SEC
+MAX_LONG_POLLS = 256
+CHANGES_RETRY_SEC = 5
+# journal records per changes reply, so a reply stays under MAX_FRAME; a
+# client further behind gets the rest on its next poll, which is answered at
+# once
+CHANGES_PAGE = 10000
+# request types timed under their own label; anything else counts as "other"
+REQUEST_TYPES = (
+    "list", "list_stream", "stat", "tree_diff", "rescan", "changes_since", "metrics", "push", "pull",
+    "part_info", "push_batch", "pull_batch", "move", "signature", "push_delta", "pull_delta",
+    "range_info", "push_begin", "push_range", "push_commit", "pull_range",
+)
 
-if not os.path.exists(CERT_DIR):
-    raise SystemExit(f"Certificate directory '{CERT_DIR}' does not exist.")
-if not os.path.isfile(SERVER_CERT):
-    raise SystemExit(f"Server certificate '{SERVER_CERT}' does not exist.")
-if not os.path.isfile(SERVER_KEY):
-    raise SystemExit(f"Server key '{SERVER_KEY}' does not exist.")
-if not os.path.isfile(PEER_CERT):
-    raise SystemExit(f"Peer certificate '{PEER_CERT}' does not exist.")
 
-print(f"Using server certificate: {SERVER_CERT}")
+def get_server_cert():
+    CERT_DIR = os.path.expanduser('~/sync-certs')
+    SERVER_CERT = os.path.join(CERT_DIR, 'linux.crt')
+    SERVER_KEY = os.path.join(CERT_DIR, 'linux.key')
+    PEER_CERT = os.path.join(CERT_DIR, 'android.crt')
+    if not os.path.exists(CERT_DIR):
+        raise SystemExit(f"Certificate directory '{CERT_DIR}' does not exist.")
+    if not os.path.isfile(SERVER_CERT):
+        raise SystemExit(f"Server certificate '{SERVER_CERT}' does not exist.")
+    if not os.path.isfile(SERVER_KEY):
+        raise SystemExit(f"Server key '{SERVER_KEY}' does not exist.")
+    if not os.path.isfile(PEER_CERT):
+        raise SystemExit(f"Peer certificate '{PEER_CERT}' does not exist.")
+    return SERVER_CERT, SERVER_KEY, PEER_CERT
 
 
-context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-context.load_cert_chain(SERVER_CERT, SERVER_KEY)
-context.load_verify_locations(PEER_CERT)
-context.check_hostname = False
-context.verify_mode = ssl.CERT_REQUIRED
+def make_server_context(SERVER_CERT, SERVER_KEY, PEER_CERT):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(SERVER_CERT, SERVER_KEY)
+    context.load_verify_locations(PEER_CERT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    return context
 
-print("ssl context created with server certificate and peer verification.")
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server_socket.bind(("0.0.0.0", 5555))
-server_socket.listen(5)
-print("Server listening on port 5555...")
+indexes = {}
+indexes_lock = threading.Lock()
 
 
-def handle_client(client_socket, client_address):
-    print(f"handling client {client_address}")
+def get_index(cfg, local_dir):
+    with indexes_lock:
+        if local_dir not in indexes:
+            indexes[local_dir] = open_index(cfg, local_dir)
+        return indexes[local_dir]
+
+
+live_indexes = {}
+live_lock = threading.Lock()
+
+
+def get_live(cfg, local_dir):
+    # the first call for a directory does the one full scan and starts watching it
+    if not cfg.get("live_index", True):
+        return None
+    with live_lock:
+        if local_dir not in live_indexes:
+            live = LiveIndex(local_dir, index=get_index(cfg, local_dir), workers=cfg.get("scan_workers", SCAN_WORKERS))
+            live_indexes[local_dir] = live.start()
+        return live_indexes[local_dir]
+
+
+def list_files(cfg, local_dir):
+    # (generation, entries) from the live index, or (None, a fresh scan) when
+    # it is turned off; the scan is a generator so streamed listings stay lazy
+    live = get_live(cfg, local_dir)
+    if live is not None:
+        return live.snapshot()
+    return None, iter_entries(local_dir, index=get_index(cfg, local_dir), workers=cfg.get("scan_workers", SCAN_WORKERS))
+
+
+def note_written(cfg, paths, moves=None):
+    live = live_indexes.get(cfg['local_dir'])
+    if live is not None:
+        live.update(paths, moves)
+
+
+def note_hashed(cfg, path, abs_path, digest):
+    # the digest was taken from the bytes as they were written, so the index
+    # doesn't have to read the file again
+    index = get_index(cfg, cfg['local_dir'])
+    if index is not None:
+        index.store(path, os.stat(abs_path), digest)
+        index.commit()
+
+
+def handle_message(tls_conn, rfile, rid, message, client_address, buf, state):
+    kind = message.get("type") if message.get("type") in REQUEST_TYPES else "other"
+    with metrics.timed("filesync_request_seconds", type=kind):
+        dispatch(tls_conn, rfile, rid, message, client_address, buf, state)
+
+
+def dispatch(tls_conn, rfile, rid, message, client_address, buf, state):
+    if message.get("type") == "list":
+        cfg = get_config()
+        local_dir = cfg['local_dir']
+        generation, files = list_files(cfg, local_dir)
+        files = list(files)
+        print(f"sending {len(files)} files to {client_address}")
+        send_msg(tls_conn, {"type": "list_response", "files": files, "generation": generation}, rid)
+
+    elif message.get("type") == "list_stream":
+        cfg = get_config()
+        local_dir = cfg['local_dir']
+        compress = pick_codec([message.get("compress")])
+        generation, files = list_files(cfg, local_dir)
+        send_msg(tls_conn, {"type": "list_stream_response", "compress": compress, "generation": generation}, rid)
+        raw, sent = send_list(tls_conn, files, rid, compress)
+        print(f"streamed listing to {client_address}: {raw} bytes, {sent} on the wire")
+
+    elif message.get("type") == "stat":
+        cfg = get_config()
+        local_dir = cfg['local_dir']
+        files = scan_paths(local_dir, message.get("paths", []), index=get_index(cfg, local_dir))
+        if message.get("stream"):
+            codec = state.get("codec")
+            send_msg(tls_conn, {"type": "stat_response", "stream": True, "compress": codec}, rid)
+            send_list(tls_conn, files, rid, codec)
+        else:
+            send_msg(tls_conn, {"type": "stat_response", "files": files}, rid)
+
+    elif message.get("type") == "tree_diff":
+        # the tree built for the first round is kept for the rest of the
+        # session so every round compares against the same snapshot
+        if message.get("fresh") or "tree" not in state:
+            cfg = get_config()
+            local_dir = cfg['local_dir']
+            state["tree"] = build_tree(list_files(cfg, local_dir)[1])
+        answers = [(d, describe(state["tree"], d, peer_hash)) for d, peer_hash in message.get("dirs", [])]
+        dirs = {d: reply for d, (reply, files) in answers}
+        if message.get("stream"):
+            # the file entries follow as a listing stream, a whole subtree for
+            # a fresh client included, so they are never one big message
+            codec = state.get("codec")
+            send_msg(tls_conn, {"type": "tree_diff_response", "dirs": dirs, "stream": True, "compress": codec}, rid)
+            send_list(tls_conn, itertools.chain.from_iterable(files for d, (reply, files) in answers), rid, codec)
+        else:
+            for d, (reply, files) in answers:
+                if "hash" in reply:
+                    reply["files"] = list(files)
+            send_msg(tls_conn, {"type": "tree_diff_response", "dirs": dirs}, rid)
+
+    elif message.get("type") == "rescan":
+        cfg = get_config()
+        live = get_live(cfg, cfg['local_dir'])
+        generation = live.rescan() if live is not None else None
+        send_msg(tls_conn, {"type": "rescan_response", "generation": generation}, rid)
+
+    elif message.get("type") == "metrics":
+        send_msg(tls_conn, {"type": "metrics_response", "metrics": metrics.dump()}, rid)
+
+    elif message.get("type") == "changes_since":
+        handle_changes_since(tls_conn, rid, message)
+
+    elif message.get('type') == "push":
+        path = message.get('path')
+        size = message.get('size')
+        mtime = message.get('mtime')
+
+        cfg = get_config()
+        local_dir = cfg['local_dir']
+        abs_path = os.path.join(local_dir, path)
+
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+
+        temp_path = abs_path + ".part"
+        offset = message.get("offset", 0)
+        if offset:
+            print(f"[{client_address}] Resuming {path} at {offset} bytes")
+        sha = None if offset else hashlib.sha256()
+        recvived = recv_part(rfile, temp_path, offset, rid, buf, message.get("codec"), sha=sha)
+        if recvived is None:
+            print(f"[{client_address}] ERROR: partial file for {path} is gone, can't resume")
+            send_msg(tls_conn, {"type": "error", "message": "resume_mismatch"}, rid)
+            return
+        if recvived != size:
+            print(f"[{client_address}] ERROR: size mismatch. Expected {size}, got {recvived}")
+            send_msg(tls_conn, {"type": "error", "message": "size_mismatch"}, rid)
+            return
+        os.replace(temp_path, abs_path)
+
+        if mtime is not None:
+            try:
+                os.utime(abs_path, (mtime, mtime))
+            except Exception as e:
+                print(f"[{client_address}] warning: could not set mtime for {path}: {e}")
+        if sha is not None:
+            note_hashed(cfg, path, abs_path, sha.hexdigest())
+        note_written(cfg, [path])
+        print(f"[{client_address}],File saved: {path}")
+        send_msg(tls_conn, {"type": "ack", "message": "push ok"}, rid)
+
+    elif message.get("type") == "pull":
+        path = message.get("path")
+        cfg = get_config()
+        local_dir = cfg['local_dir']
+        abs_path = os.path.join(local_dir, path)
+
+        if not os.path.exists(abs_path):
+            print(f"[{client_address}] ERROR: {path} not found")
+            send_msg(tls_conn, {"type": "error", "message": f"file not found: {path}"}, rid)
+            return
+        size = os.path.getsize(abs_path)
+        mtime = os.path.getmtime(abs_path)
+        print(f"[{client_address}] Sending {path} ({size} bytes)")
+
+        # send metadata first, then the file as DATA frames ending with END
+        with open(abs_path, 'rb') as f:
+            offset = resume_offset(f, size, message.get("offset", 0), message.get("prefix_hash"), buf)
+            if offset:
+                print(f"[{client_address}] Resuming {path} at {offset} bytes")
+            codec = choose_codec(path, f, size - offset, state.get("codec"))
+            send_msg(tls_conn, {"type": "pull_response", "path": path, "size": size, "mtime": mtime, "codec": codec, "offset": offset}, rid)
+            sent = send_file(tls_conn, f, size - offset, rid, buf, codec)
+        if sent != size - offset:
+            print(f"[{client_address}] ERROR: {path} changed while sending")
+        else:
+            print(f"[{client_address}] ✓ File sent: {path}")
+
+    elif message.get("type") == "part_info":
+        cfg = get_config()
+        abs_path = os.path.join(cfg['local_dir'], message.get("path"))
+        offset, prefix_hash = part_offer(abs_path + ".part", buf)
+        send_msg(tls_conn, {"type": "part_info_response", "offset": offset, "hash": prefix_hash}, rid)
+
+    elif message.get("type") == "push_batch":
+        cfg = get_config()
+        index = get_index(cfg, cfg['local_dir'])
+        max_file = cfg.get("batch_max_file") or BATCH_MAX_FILE
+        results = BatchUnpacker(cfg['local_dir'], index, max_file=max_file).read_stream(rfile, rid, message.get("codec"), buf)
+        if index is not None:
+            index.commit()
+        errors = {p: e for p, e in results.items() if e is not None}
+        note_written(cfg, [p for p, e in results.items() if e is None])
+        print(f"[{client_address}] batch of {len(results)} files saved, {len(errors)} failed")
+        send_msg(tls_conn, {"type": "batch_ack", "count": len(results), "errors": errors}, rid)
+
+    elif message.get("type") == "pull_batch":
+        cfg = get_config()
+        paths = message.get("paths", [])
+        codec = batch_codec(cfg['local_dir'], paths, state.get("codec"))
+        send_msg(tls_conn, {"type": "pull_batch_response", "codec": codec}, rid)
+        # the client's cap, but never more than ours
+        max_file = min(message.get("max_file", BATCH_MAX_FILE), cfg.get("batch_max_file") or BATCH_MAX_FILE)
+        missing = pack_files(BatchPacker(tls_conn, rid, codec), cfg['local_dir'], paths, max_file)
+        print(f"[{client_address}] batch of {len(paths)} files sent, {len(missing)} left out")
+
+    elif message.get("type") == "move":
+        handle_move(tls_conn, rid, message, client_address)
+
+    elif message.get("type") == "signature":
+        handle_signature(tls_conn, rid, message, client_address)
+
+    elif message.get("type") == "push_delta":
+        handle_push_delta(tls_conn, rfile, rid, message, client_address, buf)
+
+    elif message.get("type") == "pull_delta":
+        handle_pull_delta(tls_conn, rid, message, client_address)
+
+    elif message.get("type") == "range_info":
+        handle_range_info(tls_conn, rid, message)
+
+    elif message.get("type") == "push_begin":
+        handle_push_begin(tls_conn, rid, message)
+
+    elif message.get("type") == "push_range":
+        handle_push_range(tls_conn, rfile, rid, message, state)
+
+    elif message.get("type") == "push_commit":
+        handle_push_commit(tls_conn, rid, message, client_address)
+
+    elif message.get("type") == "pull_range":
+        handle_pull_range(tls_conn, rid, message, state)
+
+    else:
+        send_msg(tls_conn, {"type": "ack", "message": "ok"}, rid)
+
+
+def handle_changes_since(tls_conn, rid, message, retry_after=None):
+    # journal records after the client's cursor. "reset" tells the client its
+    # cursor can't be served and it should reconcile in full. a "wait" is
+    # honoured by SyncServer, which parks the session until there is
+    # something to send; by the time this runs the answer is ready.
+    cfg = get_config()
+    live = get_live(cfg, cfg['local_dir'])
+    if live is None:
+        send_msg(tls_conn, {"type": "error", "message": "change journal disabled"}, rid)
+        return
+    cursor = message.get("cursor")
+    changes = None
+    if message.get("epoch") == live.epoch:
+        changes = live.changes_since(cursor)
+        if changes is not None:
+            changes = changes[:CHANGES_PAGE]
+    reply = {"type": "changes", "epoch": live.epoch, "generation": live.generation}
+    if changes is None:
+        reply["reset"] = True
+    else:
+        reply["changes"] = changes
+        reply["generation"] = changes[-1]["seq"] if changes else cursor
+    if retry_after is not None:
+        reply["retry_after"] = retry_after
+    send_msg(tls_conn, reply, rid)
+
+
+def handle_move(tls_conn, rid, message, client_address):
+    # renames or copies a file this side already has instead of receiving its
+    # bytes again; the source must still hash to what the client planned with
+    cfg = get_config()
+    local_dir = cfg['local_dir']
+    source, path = message.get("source"), message.get("path")
+    src_path = os.path.join(local_dir, source)
+    abs_path = os.path.join(local_dir, path)
+    index = get_index(cfg, local_dir)
     try:
-        with context.wrap_socket(client_socket, server_side=True) as tls_conn:
-            data = tls_conn.recv(4096)
-            message = json.loads(data.decode("utf-8"))
-            print(f"Received message from {client_address}: {message}")
+        digest = index.digest(source, src_path) if index is not None else compute_hash(src_path)
+    except OSError:
+        send_msg(tls_conn, {"type": "error", "message": f"file not found: {source}"}, rid)
+        return
+    if digest != message.get("hash"):
+        send_msg(tls_conn, {"type": "error", "message": f"source changed: {source}"}, rid)
+        return
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    if message.get("copy"):
+        temp_path = abs_path + ".part"
+        shutil.copyfile(src_path, temp_path)
+        os.replace(temp_path, abs_path)
+        written = [path]
+    else:
+        os.replace(src_path, abs_path)
+        written = [source, path]
+    mtime = message.get("mtime")
+    if mtime is not None:
+        try:
+            os.utime(abs_path, (mtime, mtime))
+        except Exception as e:
+            print(f"[{client_address}] warning: could not set mtime for {path}: {e}")
+    note_written(cfg, written, {path: source})
+    print(f"[{client_address}] {'Copied' if message.get('copy') else 'Renamed'} {source} -> {path}")
+    send_msg(tls_conn, {"type": "ack", "message": "move ok"}, rid)
 
-            response = None
-
-            if message.get("type") == "list":
-                cfg = get_config()
-                local_dir = cfg['local_dir']
-                files = scan_dir(local_dir)
-                response = {"type": "list_response", "files": files}
-                print(f"sending {len(files)} files to {client_address}")
-
-            elif message.get('type') == "push":
-                path = message.get('path')
-                size = message.get('size')
-                mtime = message.get('mtime') 
-
-                cfg = get_config()
-                local_dir = cfg['local_dir']
-                abs_path = os.path.join(local_dir, path)
-
-                os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-
-                temp_path = abs_path + ".part"
-                with open(temp_path, "wb") as f:
-                    recvived = 0
-                    while recvived < size:
-                        chunk = tls_conn.recv(min(8192, size - recvived))
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                        recvived += len(chunk)
-                if recvived != size:
-                    print(f"[{client_address}] ERROR: size mismatch. Expected {size}, got {recvived}")
-                    response = {"type": "error", "message": "size_mismatch"}
-                else:
-                    os.replace(temp_path, abs_path)
-                   
-                    if mtime is not None:
-                        try:
-                            os.utime(abs_path, (mtime, mtime))
-                        except Exception as e:
-                            print(f"[{client_address}] warning: could not set mtime for {path}: {e}")
-                    print(f"[{client_address}],File saved: {path}")
-                    response = {"type": "ack", "message": "push ok"}
-
-            elif message.get("type") == "pull":
-                path = message.get("path")
-                cfg = get_config()
-                local_dir = cfg['local_dir']
-                abs_path = os.path.join(local_dir, path)
-
-                if not os.path.exists(abs_path):
-                    response = {"type": "error", "message": f"file not found: {path}"}
-                    print(f"[{client_address}] ERROR: {path} not found")
-                else:
-                    size = os.path.getsize(abs_path)
-                    mtime = os.path.getmtime(abs_path)
-                    print(f"[{client_address}] Sending {path} ({size} bytes)")
-
-                    # send metadata first
-                    meta = {"type": "pull_response", "path": path, "size": size, "mtime": mtime}
-                    tls_conn.send(json.dumps(meta).encode("utf-8"))
-
-                    # stream file
-                    with open(abs_path, 'rb') as f:
-                        while True:
-                            chunk = f.read(8192)
-                            if not chunk:
-                                break
-                            tls_conn.send(chunk)
-
-                    print(f"[{client_address}] ✓ File sent: {path}")
-                    response = None  
 
-            else:
-                response = {"type": "ack", "message": "ok"}
+def handle_signature(tls_conn, rid, message, client_address):
+    path = message.get("path")
+    abs_path = os.path.join(get_config()['local_dir'], path)
+    if not os.path.isfile(abs_path):
+        send_msg(tls_conn, {"type": "error", "message": f"file not found: {path}"}, rid)
+        return
+    size = os.path.getsize(abs_path)
+    block_size = block_size_for(size)
+    with open(abs_path, "rb") as f:
+        blocks = signature(f, block_size)
+    print(f"[{client_address}] signature for {path}: {len(blocks)} blocks of {block_size}")
+    send_msg(tls_conn, {"type": "signature_response", "size": size, "block_size": block_size, "blocks": blocks}, rid)
+
+
+def handle_push_delta(tls_conn, rfile, rid, message, client_address, buf):
+    path = message.get("path")
+    size = message.get("size")
+    mtime = message.get("mtime")
+    abs_path = os.path.join(get_config()['local_dir'], path)
+    temp_path = abs_path + ".part"
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    try:
+        basis = open(abs_path, "rb")
+    except OSError:
+        basis = None
+    try:
+        with open(temp_path, "wb") as out:
+            got, digest, expected = recv_delta(rfile, rid, basis, out, message.get("block_size"), buf)
+    finally:
+        if basis is not None:
+            basis.close()
+    if got != size or digest != expected:
+        print(f"[{client_address}] ERROR: delta for {path} did not rebuild the file")
+        os.remove(temp_path)
+        send_msg(tls_conn, {"type": "error", "message": "delta_mismatch"}, rid)
+        return
+    os.replace(temp_path, abs_path)
+    if mtime is not None:
+        try:
+            os.utime(abs_path, (mtime, mtime))
+        except Exception as e:
+            print(f"[{client_address}] warning: could not set mtime for {path}: {e}")
+    note_hashed(get_config(), path, abs_path, digest)
+    note_written(get_config(), [path])
+    print(f"[{client_address}],File rebuilt from delta: {path}")
+    send_msg(tls_conn, {"type": "ack", "message": "push ok"}, rid)
 
-            if response is not None:
-                tls_conn.send(json.dumps(response).encode("utf-8"))
-                print(f"sent response to {client_address}")
-    except Exception as e:
-        print(f"Error handling client {client_address}: {e}")
+
+def handle_pull_delta(tls_conn, rid, message, client_address):
+    path = message.get("path")
+    abs_path = os.path.join(get_config()['local_dir'], path)
+    if not os.path.isfile(abs_path):
+        send_msg(tls_conn, {"type": "error", "message": f"file not found: {path}"}, rid)
+        return
+    size = os.path.getsize(abs_path)
+    mtime = os.path.getmtime(abs_path)
+    send_msg(tls_conn, {"type": "pull_delta_response", "path": path, "size": size, "mtime": mtime}, rid)
+    with open(abs_path, "rb") as f:
+        literal, copied = send_delta(tls_conn, f, message.get("blocks", []), message.get("block_size"), rid)
+    print(f"[{client_address}] ✓ Delta sent: {path} ({literal} literal bytes, {copied} reused)")
+
+
+def handle_range_info(tls_conn, rid, message):
+    # size, mtime and sha-256 a striped pull checks its stripes and result
+    # against; "part_offset" is how much of the client's .part, if it sent a
+    # prefix hash for one, matches this file
+    cfg = get_config()
+    path = message.get("path")
+    abs_path = os.path.join(cfg['local_dir'], path)
+    index = get_index(cfg, cfg['local_dir'])
+    try:
+        st = os.stat(abs_path)
+        digest = index.digest(path, abs_path, st) if index is not None else hash_file(abs_path)
+        part_offset = 0
+        if message.get("offset"):
+            with open(abs_path, "rb") as f:
+                part_offset = resume_offset(f, st.st_size, message["offset"], message.get("prefix_hash"))
+    except OSError:
+        send_msg(tls_conn, {"type": "error", "message": f"file not found: {path}"}, rid)
+        return
+    send_msg(tls_conn, {"type": "range_info_response", "size": st.st_size, "mtime": st.st_mtime, "hash": digest,
+                        "part_offset": part_offset}, rid)
+
+
+# RangeLog of every striped push in progress, by absolute path
+range_logs = {}
+range_logs_lock = threading.Lock()
+
+
+def handle_push_begin(tls_conn, rid, message):
+    # picks up the ranges an earlier attempt at the same version left, or
+    # starts from the prefix of our .part the client confirmed
+    abs_path = os.path.join(get_config()['local_dir'], message.get("path"))
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    log = RangeLog.open(abs_path, message.get("size"), message.get("hash"), message.get("part_offset", 0))
+    with range_logs_lock:
+        range_logs[abs_path] = log
+    send_msg(tls_conn, {"type": "push_begin_ok", "missing": log.missing()}, rid)
+
+
+def handle_push_range(tls_conn, rfile, rid, message, state):
+    abs_path = os.path.join(get_config()['local_dir'], message.get("path"))
+    buf = state.setdefault("range_buf", bytearray(STRIPE_CHUNK))
+    with range_logs_lock:
+        log = range_logs.get(abs_path)
+    fd = None
+    if log is not None:
+        try:
+            fd = os.open(log.temp_path, os.O_WRONLY)
+        except OSError:
+            pass
+    # without a file to write to the data is read and dropped
+    try:
+        got = recv_range(rfile, fd, message.get("offset"), rid, buf, log=log if fd is not None else None)
     finally:
-        client_socket.close()
+        if fd is not None:
+            os.close(fd)
+            # whatever arrived is kept for the retry, even if the stream broke
+            log.save()
+    if fd is None:
+        send_msg(tls_conn, {"type": "error", "message": "no push_begin for this file"}, rid)
+    elif got != message.get("length"):
+        send_msg(tls_conn, {"type": "error", "message": "size_mismatch"}, rid)
+    else:
+        send_msg(tls_conn, {"type": "push_range_ok", "received": got}, rid)
+
+
+def handle_push_commit(tls_conn, rid, message, client_address):
+    # every range is in; the file only replaces the old one if it hashes right
+    cfg = get_config()
+    path = message.get("path")
+    abs_path = os.path.join(cfg['local_dir'], path)
+    with range_logs_lock:
+        log = range_logs.pop(abs_path, None)
+    if log is None or not os.path.exists(log.temp_path):
+        send_msg(tls_conn, {"type": "error", "message": "no push_begin for this file"}, rid)
+        return
+    digest = hash_file(log.temp_path) if not log.missing() else None
+    if digest != message.get("hash"):
+        print(f"[{client_address}] ERROR: striped push of {path} does not match its hash")
+        log.discard()
+        send_msg(tls_conn, {"type": "error", "message": "hash_mismatch"}, rid)
+        return
+    os.replace(log.temp_path, abs_path)
+    log.finish()
+    mtime = message.get("mtime")
+    if mtime is not None:
+        try:
+            os.utime(abs_path, (mtime, mtime))
+        except Exception as e:
+            print(f"[{client_address}] warning: could not set mtime for {path}: {e}")
+    note_hashed(cfg, path, abs_path, digest)
+    note_written(cfg, [path])
+    print(f"[{client_address}],File saved from ranges: {path}")
+    send_msg(tls_conn, {"type": "ack", "message": "push ok"}, rid)
+
+
+def handle_pull_range(tls_conn, rid, message, state):
+    path = message.get("path")
+    abs_path = os.path.join(get_config()['local_dir'], path)
+    offset, length = message.get("offset"), message.get("length")
+    try:
+        f = open(abs_path, "rb")
+    except OSError:
+        send_msg(tls_conn, {"type": "error", "message": f"file not found: {path}"}, rid)
+        return
+    with f:
+        st = os.fstat(f.fileno())
+        # every stripe has to come from the same version of the file
+        if st.st_size != message.get("size") or st.st_mtime != message.get("mtime"):
+            send_msg(tls_conn, {"type": "error", "message": f"file changed: {path}"}, rid)
+            return
+        f.seek(offset)
+        send_msg(tls_conn, {"type": "pull_range_response", "offset": offset, "length": length}, rid)
+        send_file(tls_conn, f, length, rid, state.setdefault("range_buf", bytearray(STRIPE_CHUNK)))
+
+
+class Session:
+    # an authenticated session connection; it moves between pool workers when
+    # it parks in a long poll
+    def __init__(self, tls_conn, rfile, client_address, buf, state):
+        self.tls_conn = tls_conn
+        self.rfile = rfile
+        self.client_address = client_address
+        self.buf = buf
+        self.state = state
+        self.handled = 0
+        # (rid, message) of the changes_since it is parked in
+        self.poll = None
+
+
+class LongPolls:
+    # sessions waiting in a changes_since long poll. they hold no pool worker
+    # while they wait: one thread watches them and hands each back to
+    # resume(session) once its live index moves past the cursor or the wait
+    # runs out. at most `limit` sessions wait at once.
+    def __init__(self, resume, limit=MAX_LONG_POLLS):
+        self.resume = resume
+        self.limit = limit
+        # session -> (live index, cursor, deadline)
+        self.waiting = {}
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def park(self, session, live, cursor, wait):
+        with self.cond:
+            if self.stopped or len(self.waiting) >= self.limit:
+                return False
+            if self.wake not in live.listeners:
+                live.listeners.append(self.wake)
+            self.waiting[session] = (live, cursor, time.monotonic() + wait)
+            metrics.set_gauge("filesync_long_polls", len(self.waiting))
+            self.cond.notify()
+            return True
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    def stop(self):
+        # returns the sessions still waiting, for the caller to close
+        with self.cond:
+            self.stopped = True
+            sessions = list(self.waiting)
+            self.waiting.clear()
+            self.cond.notify()
+        return sessions
+
+    def _run(self):
+        with self.cond:
+            while not self.stopped:
+                now = time.monotonic()
+                for session, (live, cursor, deadline) in list(self.waiting.items()):
+                    if deadline <= now or live.stopped or live.generation != cursor:
+                        del self.waiting[session]
+                        self.resume(session)
+                metrics.set_gauge("filesync_long_polls", len(self.waiting))
+                deadlines = [d for _, _, d in self.waiting.values()]
+                self.cond.wait(max(0, min(deadlines) - now) if deadlines else None)
+
+
+class SyncServer:
+    # a fixed pool of max_connections workers serves accepted connections.
+    # at most max_connections accepted sockets wait for a worker; once that
+    # many are waiting the accept loop stops accepting and further clients
+    # wait in the kernel's listen backlog, so load never turns into more
+    # threads or buffers. a session parked in a long poll (LongPolls) gives
+    # its worker back and is queued again when its answer is ready.
+    def __init__(self, host, port, context, max_connections=16, handshake_timeout=10, max_long_polls=MAX_LONG_POLLS):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.max_connections = max(1, int(max_connections))
+        self.handshake_timeout = handshake_timeout
+        # accepted sockets and resumed sessions, for the workers
+        self.queue = queue.Queue()
+        self.backlog = threading.Semaphore(self.max_connections)
+        self.polls = LongPolls(self.queue.put, max_long_polls)
+        self.stopping = threading.Event()
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        self.server_socket = None
+
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.max_connections)
+        self.server_socket.settimeout(1.0)
+        self.port = self.server_socket.getsockname()[1]
+        for i in range(self.max_connections):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+        self.polls.start()
+        print(f"Server listening on {self.host}:{self.port} with {self.max_connections} workers...")
+        return self
+
+    def serve_forever(self):
+        while not self.stopping.is_set():
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                if self.stopping.is_set():
+                    break
+                raise
+            print(f"Connection accepted from {client_address}")
+            while not self.stopping.is_set():
+                if self.backlog.acquire(timeout=1.0):
+                    self.queue.put((client_socket, client_address))
+                    metrics.set_gauge("filesync_queue_depth", self.queue.qsize(), queue="connections")
+                    break
+            else:
+                client_socket.close()
+
+    def shutdown(self, timeout=30):
+        # stop accepting, drop idle and parked sessions and let busy ones
+        # finish their current request before the workers exit
+        print("Server shutting down...")
+        self.stopping.set()
+        if self.server_socket is not None:
+            self.server_socket.close()
+        for session in self.polls.stop():
+            self._close(session.tls_conn, session.rfile, session.client_address)
+        with self.lock:
+            for conn, busy in self.connections.items():
+                if not busy:
+                    self._hangup(conn)
+        for t in self.workers:
+            self.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for t in self.workers:
+            t.join(max(0, deadline - time.monotonic()))
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if isinstance(item, Session):
+                self._close(item.tls_conn, item.rfile, item.client_address)
+        print(compression_summary())
+
+    def _hangup(self, conn):
+        # bypasses the ssl layer so a thread blocked reading this connection
+        # wakes up with EOF instead of waiting for the client
+        try:
+            socket.socket.shutdown(conn, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _set_busy(self, conn, busy):
+        with self.lock:
+            if not busy and self.stopping.is_set():
+                return False
+            self.connections[conn] = busy
+            self._count_connections()
+            return True
+
+    def _count_connections(self):
+        # called with self.lock held
+        busy = sum(1 for b in self.connections.values() if b)
+        metrics.set_gauge("filesync_connections", busy, state="busy")
+        metrics.set_gauge("filesync_connections", len(self.connections) - busy, state="idle")
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            metrics.set_gauge("filesync_queue_depth", self.queue.qsize(), queue="connections")
+            if item is None:
+                break
+            if isinstance(item, Session):
+                self.resume_session(item)
+            else:
+                self.backlog.release()
+                self.handle_client(*item)
+
+    def _long_poll(self, session, rid, message):
+        # True if the session was parked; otherwise the poll has been answered
+        wait = min(message.get("wait", 0), CHANGES_WAIT_MAX)
+        cfg = get_config()
+        live = get_live(cfg, cfg['local_dir'])
+        if not wait or live is None or message.get("epoch") != live.epoch or message.get("cursor") != live.generation:
+            handle_message(session.tls_conn, session.rfile, rid, message, session.client_address, session.buf, session.state)
+            return False
+        session.poll = (rid, message)
+        self._set_busy(session.tls_conn, False)
+        if self.polls.park(session, live, message.get("cursor"), wait):
+            return True
+        session.poll = None
+        self._set_busy(session.tls_conn, True)
+        handle_changes_since(session.tls_conn, rid, message, retry_after=CHANGES_RETRY_SEC)
+        return False
+
+    def serve_session(self, session):
+        # one authenticated connection carries many requests; every reply and
+        # data frame is tagged with the id of the request it answers. returns
+        # True if the session was parked rather than finished
+        tls_conn, rfile = session.tls_conn, session.rfile
+        while self._set_busy(tls_conn, False):
+            rid, message = recv_msg(rfile)
+            self._set_busy(tls_conn, True)
+            if message is None or message.get("type") == "bye":
+                break
+            if message.get("type") == "changes_since":
+                if self._long_poll(session, rid, message):
+                    return True
+            else:
+                handle_message(tls_conn, rfile, rid, message, session.client_address, session.buf, session.state)
+            session.handled += 1
+        print(f"session closed for {session.client_address} after {session.handled} requests")
+        return False
+
+    def resume_session(self, session):
+        # answers the long poll the session was parked in, then serves it on
+        parked = False
+        try:
+            rid, message = session.poll
+            session.poll = None
+            self._set_busy(session.tls_conn, True)
+            handle_message(session.tls_conn, session.rfile, rid, message, session.client_address, session.buf, session.state)
+            session.handled += 1
+            parked = self.serve_session(session)
+        except Exception as e:
+            print(f"Error handling client {session.client_address}: {e}")
+        finally:
+            if not parked:
+                self._close(session.tls_conn, session.rfile, session.client_address)
+
+    def handle_client(self, client_socket, client_address):
+        print(f"handling client {client_address}")
+        tls_conn = rfile = None
+        parked = False
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            client_socket.settimeout(self.handshake_timeout)
+            start = time.perf_counter()
+            tls_conn = self.context.wrap_socket(client_socket, server_side=True)
+            metrics.observe("filesync_tls_handshake_seconds", time.perf_counter() - start, side="server")
+            tls_conn.settimeout(None)
+            self._set_busy(tls_conn, True)
+            rfile = tls_conn.makefile("rb")
+            ratelimit.attach(client_address[0], tls_conn, rfile)
+            buf = bytearray(CHUNK_SIZE)
+            rid, message = recv_msg(rfile)
+            if message is None:
+                return
+            print(f"Received message from {client_address}: {message}")
+
+            if message.get("type") == "session":
+                state = {"codec": pick_codec(message.get("compress"))}
+                send_msg(tls_conn, {"type": "session_ok", "compress": state["codec"], "features": FEATURES})
+                print(f"session opened for {client_address} (compression: {state['codec']})")
+                parked = self.serve_session(Session(tls_conn, rfile, client_address, buf, state))
+            else:
+                handle_message(tls_conn, rfile, rid, message, client_address, buf, {})
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            if not parked:
+                client_socket.close()
+                self._close(tls_conn, rfile, client_address)
+
+    def _close(self, tls_conn, rfile, client_address):
+        if tls_conn is not None:
+            with self.lock:
+                self.connections.pop(tls_conn, None)
+                self._count_connections()
+            if rfile is not None:
+                rfile.close()
+            tls_conn.close()
         print(f"Connection closed for {client_address}")
-try:
-    while True:
-        print("waiting for client connection...")
-        client_socket, client_address = server_socket.accept()
-        print(f"Connection accepted from {client_address}")
-
-
-        client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-        client_thread.daemon = True
-        client_thread.start()
-except KeyboardInterrupt:
-    print("Server shutting down...")
-    server_socket.close()
\ No newline at end of file
+
+
+def serve(host=None, port=None, context=None, max_connections=None):
+    cfg = get_config()
+    server_cfg = cfg.get("server", {})
+    if host is None:
+        host = server_cfg.get("host", "0.0.0.0")
+    if port is None:
+        port = server_cfg.get("port", 5555)
+    if max_connections is None:
+        max_connections = server_cfg.get("max_connections", 16)
+    metrics.configure(cfg)
+    ratelimit.configure(cfg)
+    # request handlers read get_config() per request, which is a cached dict;
+    # settings only read here (bind address, workers, metrics port) need a restart
+    CONFIG.on_change(metrics.configure)
+    CONFIG.on_change(ratelimit.configure)
+    metrics_port = server_cfg.get("metrics_port", 9555)
+    httpd = None
+    if metrics_port:
+        httpd = metrics.serve_metrics(server_cfg.get("metrics_host", "127.0.0.1"), metrics_port)
+    if context is None:
+        certs = get_server_cert()
+        print(f"Using server certificate: {certs[0]}")
+        context = make_server_context(*certs)
+        print("ssl context created with server certificate and peer verification.")
+
+    get_live(cfg, cfg['local_dir'])
+    max_long_polls = server_cfg.get("max_long_polls", MAX_LONG_POLLS)
+    server = SyncServer(host, port, context, max_connections=max_connections, max_long_polls=max_long_polls).start()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stopping.set())
+        reload_on_signal()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for live in live_indexes.values():
+            live.stop()
+        server.shutdown()
+        if httpd is not None:
+            httpd.shutdown()
+
+
+if __name__ == "__main__":
+    serve()
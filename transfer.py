@@ -0,0 +1,473 @@
+import fnmatch
+import itertools
+import os
+import queue
+import threading
+import time
+import metrics
+from tls_client import open_session, push, pull, action_path
+from protocol import compression_summary
+from batch import BATCH_MAX_FILE, TOO_LARGE_ERROR, group_small
+from stripe import STRIPE_MIN_SIZE
+from hasher import copy_hashed
+
+
+# files at least this big that exist on both sides go through delta transfer
+DELTA_MIN_SIZE = 1024 * 1024
+
+# transfer order: paths matching an earlier glob go first, then smaller size
+# classes, then newer files. files up to SMALL_FILE share the first class,
+# above that every doubling of size is a class of its own.
+DEFAULT_PRIORITY = {"globs": [], "small_first": True, "recent_first": True}
+SMALL_FILE = 1024 * 1024
+
+# parallel connections for one file of at least stripe_min_size
+STRIPES = 4
+
+
+class SyncCancelled(Exception):
+    pass
+
+
+# planned moves: server-side rename/copy and local copy of content already present
+MOVE_KINDS = ("rename", "copy", "copy_local")
+
+
+def has_work(actions):
+    return any(actions[kind] for kind in ("push", "pull") + MOVE_KINDS)
+
+
+def make_jobs(actions, batch_max_file=BATCH_MAX_FILE):
+    jobs = []
+    for kind in MOVE_KINDS:
+        for a in actions.get(kind, []):
+            jobs.append({"kind": kind, "path": a["path"], "entry": a, "attempts": 0})
+    for kind in ("push", "pull"):
+        entries = actions[kind]
+        if batch_max_file:
+            batches, entries = group_small(entries, max_file=batch_max_file)
+            for paths in batches:
+                jobs.append({"kind": kind + "_batch", "paths": paths, "path": f"{len(paths)} files", "max_file": batch_max_file, "attempts": 0})
+        for a in entries:
+            job = {"kind": kind, "path": action_path(a), "size": None, "mtime": None, "hash": None, "attempts": 0}
+            if isinstance(a, dict):
+                job["size"], job["mtime"], job["hash"] = a.get("size"), a.get("mtime"), a.get("hash")
+                job["remote"] = bool(a.get("remote"))
+            jobs.append(job)
+    return jobs
+
+
+def job_paths(job):
+    if "paths" in job:
+        return list(job["paths"])
+    if "entry" in job:
+        return [job["path"], job["entry"]["source"]]
+    return [job["path"]]
+
+
+def job_priority(job, rules):
+    # sort key, lowest first. moves only touch metadata so they lead; batches
+    # are small files by construction
+    if job["kind"] in MOVE_KINDS:
+        return (-1,)
+    globs = rules.get("globs", [])
+    paths = job_paths(job)
+    rank = next((i for i, g in enumerate(globs) if any(fnmatch.fnmatch(p, g) for p in paths)), len(globs))
+    size = job.get("size") or 0
+    size_class = max(0, size.bit_length() - SMALL_FILE.bit_length() + 1) if rules.get("small_first", True) and size > SMALL_FILE else 0
+    age = -(job.get("mtime") or 0) if rules.get("recent_first", True) else 0
+    return (rank, size_class, age)
+
+
+def split_batch(job):
+    kind = job["kind"][:-len("_batch")]
+    return [{"kind": kind, "path": p, "attempts": 0, **express(job)} for p in job["paths"]]
+
+
+def move_fallback(job):
+    # the transfers a move replaces: a rename stood for pushing the new path
+    # and pulling the old one back, a copy for a plain push or pull
+    entry = job["entry"]
+    sized = {"size": entry.get("size"), "mtime": entry.get("mtime"), "remote": bool(entry.get("remote")), "attempts": 0, **express(job)}
+    if job["kind"] == "rename":
+        return [{"kind": "push", "path": job["path"], **sized},
+                {"kind": "pull", "path": entry["source"], **sized}]
+    kind = "pull" if job["kind"] == "copy_local" else "push"
+    return [{"kind": kind, "path": job["path"], **sized}]
+
+
+def express(job):
+    # carried over to the jobs that replace it
+    return {"express": True} if job.get("express") else {}
+
+
+def is_error(resp):
+    return isinstance(resp, dict) and resp.get("type") == "error"
+
+
+class TransferEngine:
+    # runs push/pull jobs on up to `max_concurrency` workers. every worker keeps
+    # its own session (pipelining within it) and failed jobs go back on the
+    # queue until they have been retried `retries` times. progress(event) is
+    # called from the worker threads with "start", "bytes", "landed" and "done" events;
+    # setting `cancel` stops the sync, aborting files that are mid-stream.
+    # jobs run in `priority` order (see job_priority); add() hands a running
+    # engine more jobs, which an extra worker takes ahead of the rest. pulled
+    # files are hashed as they arrive and stored in `index` if one is given.
+    def __init__(self, host, port, context, local_dir, max_concurrency=1, retries=2, retry_delay=0.5, delta_min_size=DELTA_MIN_SIZE, progress=None, cancel=None, priority=None, stripes=STRIPES, stripe_min_size=STRIPE_MIN_SIZE, index=None):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.local_dir = local_dir
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.delta_min_size = delta_min_size
+        self.stripes = stripes
+        self.stripe_min_size = stripe_min_size
+        self.index = index
+        self.progress = progress
+        self.cancel = cancel or threading.Event()
+        self.priority = dict(DEFAULT_PRIORITY, **(priority or {}))
+        self.oneshot = False
+        self.queue = queue.PriorityQueue()
+        self.express = queue.PriorityQueue()
+        self.results = []
+        # paths of jobs queued or in flight
+        self.open = set()
+        self.finished = False
+        self.extra = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def run(self, jobs, session=None):
+        for job in jobs:
+            self._put(job)
+        workers = []
+        for i in range(min(self.max_concurrency, len(jobs))):
+            t = threading.Thread(target=self._worker, args=(session if i == 0 else None,), daemon=True)
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+        with self._lock:
+            self.finished = True
+        for t in self.extra:
+            t.join()
+        return self.results
+
+    def add(self, jobs):
+        # queues jobs on a running engine and starts a worker that takes only
+        # these, so they don't wait behind a long transfer. returns the jobs
+        # it can't take: all of them once the engine is done, otherwise those
+        # for a path it is already working on, which have to follow later.
+        rejected = []
+        with self._lock:
+            if self.finished:
+                return jobs
+            accepted = 0
+            for job in jobs:
+                if self.open.intersection(job_paths(job)):
+                    rejected.append(job)
+                    continue
+                job["express"] = True
+                self._enqueue(job)
+                accepted += 1
+            if accepted:
+                t = threading.Thread(target=self._worker, args=(None, True), daemon=True)
+                t.start()
+                self.extra.append(t)
+        return rejected
+
+    def _put(self, job):
+        with self._lock:
+            self._enqueue(job)
+
+    def _enqueue(self, job):
+        self.open.update(job_paths(job))
+        q = self.express if job.get("express") else self.queue
+        q.put((job_priority(job, self.priority), next(self._seq), job))
+
+    def _next_job(self, express_only=False):
+        metrics.set_gauge("filesync_queue_depth", self.queue.qsize() + self.express.qsize(), queue="transfer")
+        while True:
+            try:
+                job = self.express.get_nowait()[2]
+            except queue.Empty:
+                if express_only:
+                    return None
+                try:
+                    job = self.queue.get_nowait()[2]
+                except queue.Empty:
+                    return None
+            if not self.cancel.is_set():
+                self._emit("start", job, size=job.get("size"))
+                return job
+            self._record(job, False, "cancelled")
+
+    def _emit(self, event, job, **fields):
+        if self.progress is not None:
+            self.progress({"event": event, "kind": job["kind"], "path": job["path"], **fields})
+
+    def _on_bytes(self, kind, path, n):
+        if self.cancel.is_set():
+            raise SyncCancelled("sync cancelled")
+        self.progress({"event": "bytes", "kind": kind, "path": path, "bytes": n})
+
+    def _on_landed(self, path):
+        self.progress({"event": "landed", "kind": "pull", "path": path})
+
+    def _hook(self, session):
+        if self.progress is not None:
+            session.progress = self._on_bytes
+            session.landed = self._on_landed
+
+    def _open_session(self):
+        session = open_session(self.host, self.port, self.context)
+        if session is not None:
+            self._hook(session)
+        return session
+
+    def _record(self, job, ok, error=None):
+        result = {"kind": job["kind"], "path": job["path"], "ok": ok, "error": error, "attempts": job["attempts"] + 1}
+        with self._lock:
+            self.results.append(result)
+            self.open.difference_update(job_paths(job))
+        metrics.inc("filesync_files_total", kind=job["kind"], result="ok" if ok else "failed")
+        self._emit("done", job, ok=ok, error=error)
+        if not ok:
+            print(f"{job['kind']} {job['path']} failed: {error}")
+
+    def _landed(self, job, resp):
+        # resp["landed"] is (stat, digest) of a pulled file, see tls_client.landed
+        if self.index is not None and isinstance(resp, dict) and resp.get("landed"):
+            self.index.store(job["path"], *resp["landed"])
+
+    def _failed(self, job, error):
+        if self.cancel.is_set():
+            self._record(job, False, "cancelled")
+        elif job["attempts"] < self.retries:
+            job["attempts"] += 1
+            print(f"{job['kind']} {job['path']} failed ({error}), retry {job['attempts']}/{self.retries}")
+            time.sleep(self.retry_delay * job["attempts"])
+            self._put(job)
+        else:
+            self._record(job, False, error)
+
+    def _worker(self, session=None, express_only=False):
+        owned = session is None
+        if session is not None:
+            self._hook(session)
+        inflight = {}
+        while True:
+            job = self._next_job(express_only)
+            try:
+                if job is None:
+                    if not inflight:
+                        break
+                    replies = session.drain(0)
+                elif job["kind"] == "copy_local":
+                    self._copy_local(job)
+                    continue
+                elif self.oneshot:
+                    if job["kind"].endswith("_batch"):
+                        self._expand(job)
+                        continue
+                    if job["kind"] in MOVE_KINDS:
+                        self._replace(job, move_fallback(job))
+                        continue
+                    self._run_oneshot(job)
+                    continue
+                else:
+                    if session is None:
+                        session = self._open_session()
+                        owned = True
+                        if session is None:
+                            self.oneshot = True
+                            self._put(job)
+                            continue
+                    replies = self._submit(session, job, inflight)
+            except Exception as e:
+                failed = list(inflight.values())
+                if job is not None and job not in failed:
+                    failed.append(job)
+                inflight.clear()
+                if session is not None and owned:
+                    session.close()
+                session = None
+                for j in failed:
+                    self._failed(j, str(e))
+                continue
+            for kind, path, resp in replies:
+                done = inflight.pop((kind, path))
+                if is_error(resp):
+                    self._failed(done, resp.get("message"))
+                else:
+                    self._landed(done, resp)
+                    self._record(done, True)
+        if session is not None and owned:
+            session.close()
+        elif session is not None:
+            session.progress = None
+            session.landed = None
+
+    def _expand(self, job):
+        self._replace(job, split_batch(job))
+
+    def _replace(self, job, jobs):
+        # the job's outcome will be reported by `jobs` instead
+        self._emit("done", job, ok=True, split=True)
+        for j in jobs:
+            self._put(j)
+
+    def _copy_local(self, job):
+        entry = job["entry"]
+        local_file = os.path.join(self.local_dir, job["path"])
+        temp_file = local_file + ".part"
+        try:
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+            # the source may have been edited since the scan; only bytes that
+            # still hash to the remote file's digest may take its mtime
+            digest = copy_hashed(os.path.join(self.local_dir, entry["source"]), temp_file)
+            if digest != entry["hash"]:
+                os.remove(temp_file)
+                print(f"Local copy of {job['path']}: {entry['source']} changed since the scan, pulling it instead")
+                self._replace(job, move_fallback(job))
+                return
+            os.replace(temp_file, local_file)
+            os.utime(local_file, (entry["mtime"], entry["mtime"]))
+        except OSError as e:
+            print(f"Local copy of {job['path']} failed ({e}), pulling it instead")
+            self._replace(job, move_fallback(job))
+            return
+        if self.index is not None:
+            self.index.store(job["path"], os.stat(local_file), digest)
+        print(f"Copy:{entry['source']} -> {job['path']}")
+        self._record(job, True)
+
+    def _run_batch(self, session, job):
+        # batches run synchronously so their stream isn't interleaved with
+        # pipelined requests; the caller already drained the window
+        kind = job["kind"][:-len("_batch")]
+        print(f"{kind.capitalize()}: batch of {len(job['paths'])} files")
+        max_file = job.get("max_file", BATCH_MAX_FILE)
+        if kind == "push":
+            results = session.push_batch(self.local_dir, job["paths"], max_file)
+        else:
+            results = session.pull_batch(self.local_dir, job["paths"], self.index, max_file)
+        for path, error in results.items():
+            single = {"kind": kind, "path": path, "attempts": job["attempts"]}
+            if error is None:
+                self._record(single, True)
+            elif error == TOO_LARGE_ERROR:
+                # grew past the cap since it was listed: send it on its own
+                self._put(dict(single, **express(job)))
+            elif error == "not found":
+                self._record(single, False, error)
+            else:
+                self._failed(single, error)
+        self._emit("done", job, ok=True, split=True)
+
+    def _submit(self, session, job, inflight):
+        if job["kind"] in ("rename", "copy"):
+            replies = session.drain(0)
+            print(f"{job['kind'].capitalize()}:{job['entry']['source']} -> {job['path']}")
+            if session.move(job["entry"], copy=job["kind"] == "copy") is None:
+                self._replace(job, move_fallback(job))
+            else:
+                self._record(job, True)
+            return replies
+        if job["kind"].endswith("_batch"):
+            replies = session.drain(0)
+            if "batch" in session.features:
+                self._run_batch(session, job)
+            else:
+                self._expand(job)
+            return replies
+        local_file = os.path.join(self.local_dir, job["path"])
+        if job["kind"] == "push":
+            if not os.path.exists(local_file):
+                print(f"Push: {job['path']} not found")
+                self._record(job, False, "not found")
+                return []
+            print(f"Push:{job['path']}")
+            inflight[("push", job["path"])] = job
+            replies = []
+            # a path planned as new on the server has nothing to diff against;
+            # jobs without a plan behind them ("remote" unset) still try
+            if job.get("remote", True) and self._use_delta(local_file):
+                replies = session.drain(0)
+                resp = session.push_delta(local_file, job["path"])
+                if resp is not None:
+                    return replies + [("push", job["path"], resp)]
+            # no delta (or nothing on the server to diff against)
+            if self._use_stripes(session, os.path.getsize(local_file)):
+                replies += session.drain(0)
+                resp = session.push_striped(local_file, job["path"], self.stripes, self._planned_hash(job, local_file))
+                return replies + [("push", job["path"], resp)]
+            return replies + session.submit_push(local_file, job["path"])
+        print(f"Pull:{job['path']}")
+        inflight[("pull", job["path"])] = job
+        replies = []
+        if self._use_delta(local_file):
+            replies = session.drain(0)
+            resp = session.pull_delta(job["path"], local_file)
+            if resp is not None:
+                return replies + [("pull", job["path"], resp)]
+        if self._use_stripes(session, job.get("size")):
+            replies += session.drain(0)
+            return replies + [("pull", job["path"], session.pull_striped(job["path"], local_file, self.stripes))]
+        return replies + session.submit_pull(job["path"], local_file)
+
+    def _use_delta(self, local_file):
+        return bool(self.delta_min_size) and os.path.isfile(local_file) and os.path.getsize(local_file) >= self.delta_min_size
+
+    def _use_stripes(self, session, size):
+        return self.stripes > 1 and bool(self.stripe_min_size) and (size or 0) >= self.stripe_min_size and "ranges" in session.features
+
+    def _planned_hash(self, job, local_file):
+        # the digest from planning, if the file hasn't changed since
+        st = os.stat(local_file)
+        if job.get("hash") and st.st_size == job.get("size") and st.st_mtime == job.get("mtime"):
+            return job["hash"]
+        return None
+
+    def _run_oneshot(self, job):
+        local_file = os.path.join(self.local_dir, job["path"])
+        try:
+            if job["kind"] == "push":
+                if not os.path.exists(local_file):
+                    print(f"Push: {job['path']} not found")
+                    self._record(job, False, "not found")
+                    return
+                print(f"Push:{job['path']}")
+                resp = push(self.host, self.port, self.context, local_file, job["path"])
+            else:
+                print(f"Pull:{job['path']}")
+                resp = pull(self.host, self.port, self.context, job["path"], local_file)
+        except Exception as e:
+            self._failed(job, str(e))
+            return
+        if is_error(resp):
+            self._failed(job, resp.get("message"))
+        else:
+            self._record(job, True)
+
+
+def sync(host, port, context, local_dir, actions, session=None, max_concurrency=1, retries=2, delta_min_size=DELTA_MIN_SIZE, batch_max_file=BATCH_MAX_FILE, progress=None, cancel=None, priority=None, started=None, stripes=STRIPES, stripe_min_size=STRIPE_MIN_SIZE, index=None):
+    # started(engine) is called before the transfers begin, e.g. to add() to them
+    engine = TransferEngine(host, port, context, local_dir, max_concurrency=max_concurrency, retries=retries, delta_min_size=delta_min_size, progress=progress, cancel=cancel, priority=priority, stripes=stripes, stripe_min_size=stripe_min_size, index=index)
+    if started is not None:
+        started(engine)
+    with metrics.timed(phase="transfer"):
+        results = engine.run(make_jobs(actions, batch_max_file), session=session)
+    if index is not None:
+        index.commit()
+    push_count = sum(1 for r in results if r["ok"] and r["kind"] == "push")
+    pull_count = sum(1 for r in results if r["ok"] and r["kind"] == "pull")
+    moved = sum(1 for r in results if r["ok"] and r["kind"] in MOVE_KINDS)
+    failed = sum(1 for r in results if not r["ok"])
+    print(f"Sync complete. Pushed {push_count} files, Pulled {pull_count} files, {moved} renamed or copied in place, {failed} failed.")
+    metrics.log_event("sync_complete", pushed=push_count, pulled=pull_count, moved=moved, failed=failed)
+    print(compression_summary())
+    return results
@@ -4,26 +4,115 @@ from textual.containers import Horizontal,Vertical,Container
 from textual.widgets import Header, Footer, Static,Button
 from textual.binding import Binding
 from textual.reactive import reactive
-import asyncio
+import threading
+import time
+from collections import deque
+import ratelimit
 from config import get_config
-from sync_core import scan_dir
-from tls_client import request_list, compute_actions, sync, make_client_context, get_cert
+from sync_core import SCAN_WORKERS
+from hash_index import open_index
+from tls_client import plan_actions, open_session, make_client_context, get_cert, action_path
+from transfer import sync, has_work, MOVE_KINDS, DELTA_MIN_SIZE, BATCH_MAX_FILE, STRIPES, STRIPE_MIN_SIZE
+
+# seconds of history behind the MB/s figure
+RATE_WINDOW = 5.0
+
+
+class ProgressTracker:
+    # folds the transfer engine's events (sent from its worker threads) into
+    # the in-flight table and totals the UI polls; bytes of files that finish
+    # without streaming every byte (deltas, batches) are credited on completion
+    def __init__(self, actions):
+        self.lock = threading.Lock()
+        self.sizes = {}
+        for kind in ("push", "pull"):
+            for a in actions[kind]:
+                if isinstance(a, dict):
+                    self.sizes[action_path(a)] = a["size"]
+        self.total_bytes = sum(self.sizes.values())
+        self.total_files = sum(len(actions[k]) for k in ("push", "pull") + MOVE_KINDS)
+        self.active = {}
+        self.bytes_done = 0
+        self.files_done = 0
+        self.failed = 0
+        self.samples = deque([(time.monotonic(), 0)])
+
+    def __call__(self, event):
+        path = event["path"]
+        with self.lock:
+            if event["event"] == "start":
+                self.active[path] = {"kind": event["kind"], "size": event.get("size") or self.sizes.get(path, 0), "done": 0}
+            elif event["event"] == "bytes":
+                row = self.active.get(path)
+                if row is not None:
+                    row["done"] += event["bytes"]
+                self.bytes_done += event["bytes"]
+            elif event["event"] == "done":
+                row = self.active.pop(path, None)
+                if event.get("split"):
+                    return
+                self.files_done += 1
+                if not event["ok"]:
+                    self.failed += 1
+                elif path in self.sizes:
+                    self.bytes_done += max(0, self.sizes[path] - (row["done"] if row else 0))
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            rows = [(path, dict(row)) for path, row in self.active.items()]
+            done = self.bytes_done
+            self.samples.append((now, done))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= RATE_WINDOW:
+                self.samples.popleft()
+            t0, b0 = self.samples[0]
+        rate = (done - b0) / (now - t0) if now > t0 else 0.0
+        left = max(0, self.total_bytes - done)
+        eta = left / rate if rate > 0 else None
+        return rows, done, rate, eta
+
+
+def fmt_mb(n):
+    return f"{n / (1 << 20):.1f} MB"
+
+
+def fmt_eta(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 else f"{seconds // 60:02d}:{seconds % 60:02d}"
+
 
 class StatusPanel(Static):
     connected = reactive(False)
     last_sync = reactive("Never")
+    # read from the config when a sync starts, not on every repaint
+    peer = reactive("")
 
     def render(self) -> str:
         status = "Connected" if self.connected else "Disconnected"
-        cfg = get_config()
         return f"""
         [bold]sync Status [/bold]
 
         status : {status}
-        peer: {cfg["peer"]["host"]}:{cfg["peer"]["port"]}
+        peer: {self.peer}
         "last sync: {self.last_sync}
         """
 
+class ProgressPanel(Static):
+    def show(self, tracker):
+        if tracker is None:
+            self.update("")
+            return
+        rows, done, rate, eta = tracker.snapshot()
+        self.update(
+            f"[bold]Transfers[/bold]  {fmt_mb(done)} / {fmt_mb(tracker.total_bytes)}"
+            f"  {rate / (1 << 20):.2f} MB/s  ETA {fmt_eta(eta)}"
+            f"  files {tracker.files_done}/{tracker.total_files}"
+            + (f"  [red]{tracker.failed} failed[/red]" if tracker.failed else "")
+        )
+        return rows
+
 class LogPanel(Static):
 
     def __init__(self):
@@ -34,13 +123,14 @@ class LogPanel(Static):
         self.logs.append(message)
         if len(self.logs) > 100 :
             self.logs.pop(0)
-        self.update("\n".join(self.logs[-20:])) 
+        self.update("\n".join(self.logs[-20:]))
     def render(self) -> str:
         return "[bold]Log Panel[/bold]\n" + "\n".join(self.logs[-20:])
 
 class SyncApp(App):
     BINDINGS = [
-        Binding("s", "sync_files", "Sync Files"),
+        Binding("s", "sync", "Sync Files"),
+        Binding("x", "cancel_sync", "Cancel Sync"),
         Binding("q", "quit", "Quit"),
         Binding("c", "clear_logs", "Clear Logs"),
     ]
@@ -48,61 +138,123 @@ class SyncApp(App):
     def __init__(self):
         super().__init__()
         self.status_panel = StatusPanel()
+        self.progress_panel = ProgressPanel()
+        self.transfers = DataTable()
         self.log_panel = LogPanel()
-    
+        self.tracker = None
+        self.cancel_event = None
+
     def compose(self) -> ComposeResult:
         yield Header()
         with Vertical():
             yield self.status_panel
+            yield self.progress_panel
+            yield self.transfers
             yield self.log_panel
             with Horizontal():
                 yield Button("Sync Files", id="sync_button")
+                yield Button("Cancel", id="cancel_button")
                 yield Button("Clear Logs", id="clear_button")
                 yield Button("Quit", id="quit_button")
         yield Footer()
-    
+
+    def on_mount(self) -> None:
+        self.transfers.add_columns("Kind", "Path", "Progress", "Size")
+        self.load_peer()
+        self.set_interval(0.5, self.refresh_progress)
+
+    def load_peer(self):
+        try:
+            cfg = get_config()
+            self.status_panel.peer = f'{cfg["peer"]["host"]}:{cfg["peer"]["port"]}'
+        except Exception as e:
+            self.status_panel.peer = f"(config error: {e})"
+
+    def refresh_progress(self) -> None:
+        rows = self.progress_panel.show(self.tracker)
+        self.transfers.clear()
+        for path, row in rows or []:
+            pct = f"{100 * row['done'] / row['size']:.0f}%" if row["size"] else "-"
+            self.transfers.add_row(row["kind"], path, pct, fmt_mb(row["size"]))
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "sync_button":
             self.action_sync()
+        elif event.button.id == "cancel_button":
+            self.action_cancel_sync()
         elif event.button.id == "clear_button":
             self.action_clear_logs()
         elif event.button.id == "quit_button":
             self.action_quit()
 
     def action_sync(self) -> None:
+        if self.cancel_event is not None:
+            self.log_panel.add_log("a sync is already running")
+            return
         self.log_panel.add_log("starting sync....")
-        asyncio.create_task(self._do_sync())
-    
-    async def _do_sync(self):
+        self.load_peer()
+        self.cancel_event = threading.Event()
+        self.run_worker(self._do_sync, thread=True, exclusive=True, group="sync")
+
+    def action_cancel_sync(self) -> None:
+        if self.cancel_event is None:
+            return
+        self.log_panel.add_log("cancelling sync...")
+        self.cancel_event.set()
+
+    def log_from_worker(self, message):
+        self.call_from_thread(self.log_panel.add_log, message)
+
+    def _do_sync(self):
+        # runs on a worker thread; everything that touches widgets goes
+        # through call_from_thread
+        cancel = self.cancel_event
         try:
             cfg = get_config()
             host = cfg["peer"]['host']
             port = cfg["peer"]["port"]
             local_dir =cfg["local_dir"]
+            ratelimit.configure(cfg)
             context = make_client_context(*get_cert())
 
-            self.log_panel.add_log(f"Fetching remote file list from {host}:{port}...")
-            r_files = request_list(host,port,context)
-            self.log_panel.add_log(f"Remote: {len(r_files)} files")
-
-            l_files = scan_dir(local_dir)
-            self.log_panel.add_log(f"local: {len(l_files)} files")
-
-            actions = compute_actions(l_files,r_files)
-            self.log_panel.add_log(f"Actions: {len(actions['push'])} push, {len(actions['pull'])} pull, {len(actions['skip'])} skip")
-
-            sync(host,port,context,local_dir,actions)
-            self.log_panel.add_log("Sync complete.")
-            self.status_panel.last_sync = "Just now"
+            self.log_from_worker(f"Comparing with {host}:{port}...")
+            session = open_session(host,port,context)
+            self.call_from_thread(setattr, self.status_panel, "connected", True)
+            index = open_index(cfg)
+            try:
+                actions = plan_actions(session,host,port,context,local_dir,index=index,skew_sec=cfg.get("mtime_skew_sec", 2),workers=cfg.get("scan_workers", SCAN_WORKERS))
+                self.log_from_worker(f"Actions: {len(actions['push'])} push, {len(actions['pull'])} pull, {sum(len(actions[k]) for k in MOVE_KINDS)} moves, {len(actions['skip'])} skip")
+                if cancel.is_set() or not has_work(actions):
+                    results = []
+                else:
+                    self.tracker = ProgressTracker(actions)
+                    results = sync(host,port,context,local_dir,actions,session=session,max_concurrency=cfg.get("max_concurrency", 1),delta_min_size=cfg.get("delta_min_size", DELTA_MIN_SIZE),batch_max_file=cfg.get("batch_max_file", BATCH_MAX_FILE),progress=self.tracker,cancel=cancel,priority=cfg.get("transfer_priority"),stripes=cfg.get("stripes", STRIPES),stripe_min_size=cfg.get("stripe_min_size", STRIPE_MIN_SIZE),index=index)
+            finally:
+                if index is not None:
+                    index.close()
+                if session is not None:
+                    session.close()
+            failed = sum(1 for r in results if not r["ok"])
+            if cancel.is_set():
+                self.log_from_worker(f"Sync cancelled ({len(results) - failed} files done).")
+            else:
+                self.log_from_worker(f"Sync complete. {len(results) - failed} files done, {failed} failed.")
+                self.call_from_thread(setattr, self.status_panel, "last_sync", time.strftime("%H:%M:%S"))
         except Exception as e:
-            self.log_panel.add_log(f"Error during sync: {e}")
+            self.log_from_worker(f"Error during sync: {e}")
+            self.call_from_thread(setattr, self.status_panel, "connected", False)
+        finally:
+            self.cancel_event = None
+            self.call_from_thread(self.refresh_progress)
+
     def action_clear_logs(self) -> None:
         self.log_panel.logs.clear()
         self.log_panel.update("")
     def action_quit(self) -> None:
+        if self.cancel_event is not None:
+            self.cancel_event.set()
         self.exit()
-    
+
 if __name__ == "__main__":
     app = SyncApp()
     app.run()
@@ -1,70 +1,391 @@
+import os
+import queue
 import time
 import threading
+import metrics
+import ratelimit
+import fanout
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from config import get_config
-from sync_core import scan_dir
+from config import get_config, CONFIG, reload_on_signal, peer_list
+from sync_core import CHANGE_EVENTS, is_ignored, SCAN_WORKERS
+from hash_index import open_index
 from tls_client import (
     make_client_context,
     get_cert,
-    request_list,
-    compute_actions,
-    sync,
+    plan_actions,
+    open_session,
 )
+from transfer import sync, make_jobs, job_paths, has_work, MOVE_KINDS, DELTA_MIN_SIZE, BATCH_MAX_FILE, STRIPES, STRIPE_MIN_SIZE
+
+# how long one long poll of the server's change journal may wait
+REMOTE_POLL_SEC = 30
+
+# most paths handed to one sync; the rest follow in the next release
+RELEASE_BATCH = 2000
+
+# result kinds that write into local_dir
+LOCAL_WRITES = ("pull", "copy_local")
+
+# how long a file we wrote is remembered for echo suppression
+ECHO_TTL_SEC = 60
+
+# how long joining a running sync may wait for a connection before the paths
+# are left for the next sync instead
+JOIN_CONNECT_SEC = 5
+
+
+def watch_remote(host, port, context, handler):
+    # follows the server's change journal and queues the paths it names, so
+    # remote edits sync as they happen rather than at the next full pass
+    cursor = epoch = None
+    session = None
+    while True:
+        try:
+            if session is None:
+                session = open_session(host, port, context)
+                if session is None:
+                    return
+            reply = session.changes_since(cursor, epoch, wait=REMOTE_POLL_SEC)
+            if reply is None:
+                print("Server keeps no change journal; remote changes sync on full passes only.")
+                session.close()
+                return
+            if reply.get("reset"):
+                # first poll, server restart or too far behind
+                if cursor is not None:
+                    handler.request_full()
+                cursor, epoch = reply["generation"], reply["epoch"]
+                continue
+            paths = set()
+            for change in reply["changes"]:
+                paths.add(change["path"])
+                if "from" in change:
+                    paths.add(change["from"])
+            cursor = reply["generation"]
+            if paths:
+                print(f"Remote changed {len(paths)} paths.")
+                handler.add_paths(paths)
+            if reply.get("retry_after"):
+                time.sleep(reply["retry_after"])
+        except Exception as e:
+            print(f"Remote watch error: {e}")
+            if session is not None:
+                session.close()
+                session = None
+            time.sleep(5)
 
 
 class DebouncedHandler(FileSystemEventHandler):
-    def __init__(self, on_change, debounce_sec=0.8):
+    # collects the paths touched since the last sync and hands them to
+    # on_change(paths, full) from one scheduler thread. each path is released
+    # once it has been quiet for debounce_sec, or max_delay_sec after its first
+    # event even if it never goes quiet, so a file under constant writes still
+    # syncs. paths due together are released together, at most RELEASE_BATCH
+    # per call. directory creates/moves/deletes can't be expanded to file
+    # paths, so they ask for a full reconciliation instead.
+    def __init__(self, on_change, local_dir, debounce_sec=0.8, max_delay_sec=5.0):
         super().__init__()
         self.on_change = on_change
+        self.local_dir = os.path.abspath(local_dir)
         self.debounce_sec = debounce_sec
-        self._timer = None
+        self.max_delay_sec = max_delay_sec
+        # path -> [first event, last event, queued by the remote watcher]
+        self.pending = {}
+        self.full = None
+        # path -> ((size, mtime_ns) as our last sync left it, when noted)
+        self.synced = {}
         self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
 
     def on_any_event(self, event):
+        if event.event_type not in CHANGE_EVENTS:
+            return
+        metrics.inc("filesync_watch_events_total", type=event.event_type)
+        paths = [event.src_path]
+        if getattr(event, "dest_path", ""):
+            paths.append(event.dest_path)
         if event.is_directory:
+            if event.event_type != "modified":
+                self._mark_full(time.monotonic())
             return
+        # .part files are our own in-flight transfers
+        paths = [p for p in paths if not is_ignored(os.path.basename(p))]
+        if paths:
+            self.add_paths([os.path.relpath(p, self.local_dir) for p in paths], remote=False)
+
+    def add_paths(self, rel_paths, remote=True):
+        # remote paths changed on the server, so the local file looking like
+        # our last sync left it says nothing; they skip the echo check
+        now = time.monotonic()
+        with self._lock:
+            for p in rel_paths:
+                times = self.pending.get(p)
+                if times is None:
+                    self.pending[p] = [now, now, remote]
+                else:
+                    times[1] = now
+                    times[2] = times[2] or remote
+            metrics.set_gauge("filesync_queue_depth", len(self.pending), queue="watch")
+            self._wake.notify()
+
+    def _mark_full(self, now):
+        with self._lock:
+            if self.full is None:
+                self.full = [now, now]
+            else:
+                self.full[1] = now
+            self._wake.notify()
+
+    def request_full(self):
+        # due immediately
+        self._mark_full(time.monotonic() - self.max_delay_sec)
+
+    def note_synced(self, rel_paths):
+        # remembers what files we just wrote look like, so the events our own
+        # pulls cause are recognised as echoes when they come due
+        now = time.monotonic()
+        noted = [(p, self._stat(p)) for p in rel_paths]
         with self._lock:
-            if self._timer:
-                self._timer.cancel()
-            self._timer = threading.Timer(self.debounce_sec, self.on_change)
-            self._timer.daemon = True
-            self._timer.start()
+            for p in [p for p, (_, at) in self.synced.items() if now - at > ECHO_TTL_SEC]:
+                del self.synced[p]
+            for p, st in noted:
+                if st is not None:
+                    self.synced[p] = (st, now)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wake.notify()
+        self._thread.join()
+
+    def _stat(self, rel_path):
+        try:
+            st = os.stat(os.path.join(self.local_dir, rel_path))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _due_at(self, times):
+        return min(times[1] + self.debounce_sec, times[0] + self.max_delay_sec)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    due = [p for p, times in self.pending.items() if self._due_at(times) <= now]
+                    full = self.full is not None and self._due_at(self.full) <= now
+                    if due or full:
+                        break
+                    waits = [self._due_at(times) for times in self.pending.values()]
+                    if self.full is not None:
+                        waits.append(self._due_at(self.full))
+                    self._wake.wait(min(waits) - now if waits else None)
+                if full:
+                    self.full = None
+                    due = list(self.pending)
+                due = sorted(due, key=lambda p: self.pending[p][0])[:RELEASE_BATCH]
+                remote = set(p for p in due if self.pending[p][2])
+                for p in due:
+                    del self.pending[p]
+                metrics.set_gauge("filesync_queue_depth", len(self.pending), queue="watch")
+                synced = {p: self.synced.pop(p)[0] for p in due if p in self.synced and p not in remote}
+            paths = set(p for p in due if synced.get(p) is None or self._stat(p) != synced[p])
+            if len(paths) < len(due):
+                metrics.inc("filesync_watch_echoes_total", len(due) - len(paths))
+            if paths or full:
+                try:
+                    self.on_change(paths, full)
+                except Exception as e:
+                    print(f"Sync error: {e}")
 
 
 def main():
     cfg = get_config()
+    metrics.configure(cfg)
+    ratelimit.configure(cfg)
     local_dir = cfg["local_dir"]
-    host = cfg["peer"]["host"]
-    port = cfg["peer"]["port"]
-    debounce_sec = cfg.get("debounce_ms", 800) / 1000.0
-    skew_sec = cfg.get("mtime_skew_sec", 2)
+    peers = peer_list(cfg)
+    host = peers[0]["host"]
+    port = peers[0]["port"]
     context = make_client_context(*get_cert())
+    index = open_index(cfg)
+    # (paths, full) waiting for the sync thread
+    work = queue.Queue()
+    # paths waiting to be added to the running sync by join_loop
+    joins = queue.Queue()
+    # the engine of the sync that is transferring right now, if any
+    running = {}
+
+    def plan(session, paths):
+        return plan_actions(session, host, port, context, local_dir, index=index, paths=paths,
+                            skew_sec=CONFIG.get_float("mtime_skew_sec", 2),
+                            workers=CONFIG.get_int("scan_workers", SCAN_WORKERS))
+
+    def landed(event):
+        # progress from the transfer workers. each file we write is noted as
+        # soon as it lands, before the debounce of its own event comes due
+        if event["event"] == "landed" or (event["event"] == "done" and event.get("ok") and event["kind"] in LOCAL_WRITES):
+            handler.note_synced([event["path"]])
+
+    def do_sync_peers(paths=None):
+        start = time.perf_counter()
+        try:
+            fanout.sync_peers(peers, context, local_dir, index=index, paths=paths,
+                              skew_sec=CONFIG.get_float("mtime_skew_sec", 2),
+                              workers=CONFIG.get_int("scan_workers", SCAN_WORKERS),
+                              max_concurrency=CONFIG.get_int("max_concurrency", 1),
+                              delta_min_size=CONFIG.get_int("delta_min_size", DELTA_MIN_SIZE),
+                              batch_max_file=CONFIG.get_int("batch_max_file", BATCH_MAX_FILE),
+                              priority=CONFIG.value("transfer_priority"),
+                              stripes=CONFIG.get_int("stripes", STRIPES),
+                              stripe_min_size=CONFIG.get_int("stripe_min_size", STRIPE_MIN_SIZE),
+                              progress=landed)
+        except Exception as e:
+            print(f"Sync error: {e}")
+        finally:
+            metrics.observe("filesync_phase_seconds", time.perf_counter() - start, phase="watch_sync")
+            metrics.log_event("watch_sync", paths=len(paths) if paths is not None else None,
+                              peers=len(peers), seconds=round(time.perf_counter() - start, 3))
 
-    def do_sync():
+    def do_sync(paths=None):
+        # tunables are read per sync so edits to the config file apply to the
+        # next one; local_dir and peers are fixed for the life of the watcher
+        if len(peers) > 1:
+            return do_sync_peers(paths)
+        session = None
+        start = time.perf_counter()
         try:
-            r_files = request_list(host, port, context)
-            l_files = scan_dir(local_dir)
-            actions = compute_actions(l_files, r_files, skew_sec=skew_sec)
-            if actions["push"] or actions["pull"]:
-                print(f"Sync triggered: push={len(actions['push'])}, pull={len(actions['pull'])}")
-                sync(host, port, context, local_dir, actions)
+            session = open_session(host, port, context)
+            actions = plan(session, paths)
+            if has_work(actions):
+                print(f"Sync triggered: push={len(actions['push'])}, pull={len(actions['pull'])}, moves={sum(len(actions[k]) for k in MOVE_KINDS)}")
+                sync(host, port, context, local_dir, actions, session=session,
+                     max_concurrency=CONFIG.get_int("max_concurrency", 1),
+                     delta_min_size=CONFIG.get_int("delta_min_size", DELTA_MIN_SIZE),
+                     batch_max_file=CONFIG.get_int("batch_max_file", BATCH_MAX_FILE),
+                     priority=CONFIG.value("transfer_priority"),
+                     stripes=CONFIG.get_int("stripes", STRIPES),
+                     stripe_min_size=CONFIG.get_int("stripe_min_size", STRIPE_MIN_SIZE),
+                     started=lambda engine: running.update(engine=engine), index=index, progress=landed)
             else:
                 print("No changes to sync.")
         except Exception as e:
             print(f"Sync error: {e}")
+        finally:
+            running.pop("engine", None)
+            if session is not None:
+                session.close()
+            metrics.observe("filesync_phase_seconds", time.perf_counter() - start, phase="watch_sync")
+            metrics.log_event("watch_sync", paths=len(paths) if paths is not None else None,
+                              seconds=round(time.perf_counter() - start, 3))
+
+    def join_running(paths):
+        # edits made while a long sync is transferring are planned now and
+        # added to it, instead of waiting for it to finish. only with a single
+        # peer; fan-out syncs pick them up in the next pass
+        engine = running.get("engine")
+        if engine is None:
+            return False
+        session = open_session(host, port, context, timeout=JOIN_CONNECT_SEC)
+        if session is None:
+            return False
+        try:
+            actions = plan(session, sorted(paths))
+        finally:
+            session.close()
+        if not has_work(actions):
+            return True
+        jobs = make_jobs(actions, CONFIG.get_int("batch_max_file", BATCH_MAX_FILE))
+        rejected = engine.add(jobs)
+        if len(rejected) < len(jobs):
+            print(f"Added {len(jobs) - len(rejected)} transfers to the running sync.")
+        if rejected:
+            work.put((set(p for j in rejected for p in job_paths(j)), False))
+        return True
+
+    def on_change(paths, full):
+        # runs on the debouncer's thread, so it only queues: the syncs run on
+        # sync_loop and additions to a running one on join_loop
+        if not full and "engine" in running:
+            joins.put(paths)
+        else:
+            work.put((paths, full))
+
+    def join_loop():
+        while True:
+            paths = joins.get()
+            while True:
+                try:
+                    paths = paths | joins.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                if join_running(paths):
+                    continue
+            except Exception as e:
+                print(f"Could not add to the running sync: {e}")
+            work.put((paths, False))
+
+    def sync_loop():
+        while True:
+            paths, full = work.get()
+            # whatever queued up behind the last sync goes in one pass
+            while True:
+                try:
+                    more, more_full = work.get_nowait()
+                except queue.Empty:
+                    break
+                paths = paths | more
+                full = full or more_full
+            if full:
+                print("Running full reconciliation.")
+                do_sync()
+            else:
+                print(f"Syncing {len(paths)} changed paths.")
+                do_sync(sorted(paths))
+
+    handler = DebouncedHandler(on_change, local_dir,
+                               debounce_sec=CONFIG.get_float("debounce_ms", 800) / 1000.0,
+                               max_delay_sec=CONFIG.get_float("debounce_max_ms", 5000) / 1000.0)
+
+    def on_config(new_cfg):
+        metrics.configure(new_cfg)
+        ratelimit.configure(new_cfg)
+        handler.debounce_sec = CONFIG.get_float("debounce_ms", 800) / 1000.0
+        handler.max_delay_sec = CONFIG.get_float("debounce_max_ms", 5000) / 1000.0
 
-    handler = DebouncedHandler(do_sync, debounce_sec=debounce_sec)
+    CONFIG.on_change(on_config)
+    reload_on_signal()
+    threading.Thread(target=sync_loop, daemon=True).start()
+    threading.Thread(target=join_loop, daemon=True).start()
     observer = Observer()
     observer.schedule(handler, local_dir, recursive=True)
     observer.start()
     print(f"Watching {local_dir} for changes. Press Ctrl+C to stop.")
+    if cfg.get("watch_remote", True):
+        for peer in peers:
+            threading.Thread(target=watch_remote, args=(peer["host"], peer["port"], context, handler), daemon=True).start()
 
+    last_full = None
     try:
         while True:
+            # periodic full pass as a safety net for events the watcher missed;
+            # this is also where a changed config file is noticed while idle
+            full_sync_sec = CONFIG.get_float("full_sync_interval_sec", 300)
+            if last_full is None or (full_sync_sec and time.monotonic() - last_full >= full_sync_sec):
+                handler.request_full()
+                last_full = time.monotonic()
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
+        handler.stop()
     observer.join()
 
 